@@ -8,20 +8,35 @@ Requires: key.json
 Transcribe a file_id into /transcript/google
 """
 
+import argparse
+import audioop
+import fcntl
+import hashlib
 import io
 import json
 import logging
+import mmap
 import os
-import sys
+import sqlite3
+import struct
+import threading
 import wave
 from decimal import Decimal
+from multiprocessing.pool import ThreadPool
 from random import randint
-from time import sleep
+from time import sleep, time
 
-from ffmpy import FFmpeg
+import grpc
+from google.api_core import exceptions
 from google.cloud import speech
 from google.cloud.speech import enums, types
 
+try:
+    import numpy as np
+    import soundfile as sf
+except (ImportError, OSError):  # no FLAC encoding, or no libsndfile
+    sf = None
+
 CUR_DIR = os.path.dirname(os.path.realpath(__file__))
 ROOT_DIR = os.path.dirname(os.path.dirname(CUR_DIR))
 DATA_DIR = os.path.join(ROOT_DIR, 'data/')
@@ -39,6 +54,242 @@ LOG.propagate = False
 LOG.addHandler(LOG_H)
 LOG.setLevel(logging.DEBUG)
 
+REQUESTS_PER_MINUTE = 600  # default request quota, over all workers on the host
+AUDIO_PER_MINUTE = 3600  # default audio quota in seconds, over all workers on the host
+GOVERNOR_FILE = os.path.join(DATA_DIR, '_cache', 'google.governor')
+BURST = 1  # seconds of quota which can be used at once
+DECREASE = 0.5  # rate multiplier on quota errors
+RECOVERY = 0.1  # rate recovered per minute, as a fraction of the quota
+QUOTA_HOLD = 60  # seconds (a quota window) during which quota errors do not cut the rate again
+QUOTA_TIMEOUT = 120  # seconds a request is retried on quota errors before they count as failures
+MIN_SCALE = 0.05  # min fraction of the quota kept on quota errors
+MAX_REQUEST = 55  # max seconds of audio per request, below the synchronous limit
+SPLIT_SEARCH = 10  # seconds before MAX_REQUEST searched for a split point
+SPLIT_WINDOW = 0.1  # seconds per energy window when splitting
+SPLIT_OVERLAP = 1  # seconds of audio shared by consecutive chunks
+PACK_DURATION = 15  # max seconds of audio packed into a request
+PACK_GAP = 1  # max seconds between segments packed into a request
+CACHE_FILE = os.path.join(DATA_DIR, '_cache', 'google.sqlite')
+CACHE_SIZE = 64 * 2**20  # max bytes of cached transcriptions
+ENCODINGS = {
+    'linear16': enums.RecognitionConfig.AudioEncoding.LINEAR16,
+    'flac': enums.RecognitionConfig.AudioEncoding.FLAC
+}
+
+
+class Governor(object):
+    """Class holding a token bucket shared by all google workers on the host.
+
+    Each request takes a token and one per second of its audio, refilled at
+    requests_per_minute and audio_per_minute. The bucket is kept in a state
+    file locked with fcntl, so concurrent file_ids draw from the same quota.
+    The refill rate is cut by DECREASE on quota errors and recovers by
+    RECOVERY of the quota per minute.
+
+    Syntax:
+        governor = Governor(requests_per_minute, audio_per_minute, path)
+        governor.wait(seconds)
+        governor.throttle()
+    """
+
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE,
+                 audio_per_minute=AUDIO_PER_MINUTE, path=GOVERNOR_FILE):
+        if not os.path.exists(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:  # created concurrently
+                pass
+        self.request_rate = requests_per_minute / 60.0
+        self.audio_rate = audio_per_minute / 60.0
+        self.path = path
+
+    def update(self, func):
+        """Refill the shared state, apply func(state, now) to it and return the result."""
+        with open(self.path, 'a+') as file_:
+            fcntl.flock(file_, fcntl.LOCK_EX)
+            try:
+                file_.seek(0)
+                try:
+                    state = json.load(file_)
+                except ValueError:  # new state file
+                    state = dict()
+                now = time()
+                elapsed = max(0, now - state.get('time', now))
+                scale = min(1, state.get('scale', 1) + RECOVERY * elapsed / 60)
+                state['requests'] = min(BURST * self.request_rate,
+                                        state.get('requests', BURST * self.request_rate) +
+                                        elapsed * self.request_rate * scale)
+                state['audio'] = min(BURST * self.audio_rate,
+                                     state.get('audio', BURST * self.audio_rate) +
+                                     elapsed * self.audio_rate * scale)
+                state['scale'] = scale
+                state['time'] = now
+                result = func(state, now)
+                file_.seek(0)
+                file_.truncate()
+                json.dump(state, file_)
+                file_.flush()
+            finally:
+                fcntl.flock(file_, fcntl.LOCK_UN)
+        return result
+
+    def wait(self, seconds=0):
+        """Block until a request with seconds of audio is allowed."""
+        def take(state, _):
+            """Take the tokens, return how long until they are repaid."""
+            state['requests'] -= 1
+            state['audio'] -= seconds
+            return max(-state['requests'] / (self.request_rate * state['scale']),
+                       -state['audio'] / (self.audio_rate * state['scale']))
+        delay = self.update(take)
+        if delay > 0:
+            sleep(delay)
+
+    def throttle(self):
+        """Cut the rate after a quota error."""
+        def cut(state, now):
+            """Cut the rate and empty the bucket, unless just done."""
+            if now - state.get('throttled', 0) < QUOTA_HOLD:
+                return None
+            state['scale'] = max(MIN_SCALE, state['scale'] * DECREASE)
+            state['requests'] = min(0, state['requests'])
+            state['audio'] = min(0, state['audio'])
+            state['throttled'] = now
+            return state['scale']
+        scale = self.update(cut)
+        if scale is not None:
+            LOG.info('Quota exceeded, rate cut to %d%% of quota', scale * 100)
+
+
+class TranscriptCache(object):
+    """Class holding transcriptions shared across files, keyed by audio content.
+
+    Entries are stored in a sqlite database and the least recently used are
+    evicted once they add up to more than max_size bytes. Their total size is
+    kept up to date in the meta table, so that inserts do not scan the entries.
+
+    Syntax:
+        cache = TranscriptCache(path, max_size)
+        key = TranscriptCache.key(content, config)
+        trans = cache.get(key)
+        cache.put(key, trans)
+    """
+
+    def __init__(self, path=CACHE_FILE, max_size=CACHE_SIZE):
+        if not os.path.exists(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:  # created concurrently
+                pass
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS entries '
+                              '(key TEXT PRIMARY KEY, value TEXT, size INTEGER, used REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS entries_used ON entries (used)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta '
+                              '(id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER)')
+            # databases from before the meta table are summed once
+            self.conn.execute('INSERT OR IGNORE INTO meta '
+                              'SELECT 0, COALESCE(SUM(size), 0) FROM entries')
+
+    @staticmethod
+    def key(content, config):
+        """Return the key of some PCM audio recognized with a config."""
+        sha = hashlib.sha1()
+        sha.update(json.dumps(config, sort_keys=True).encode('utf-8') + b'\n')
+        sha.update(content)
+        return sha.hexdigest()
+
+    def get(self, key):
+        """Return the cached list of transcriptions for key, or None on a miss."""
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                'SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute('UPDATE entries SET used = ? WHERE key = ?', (time(), key))
+        return [x.encode('utf-8') for x in json.loads(row[0])]
+
+    def put(self, key, trans):
+        """Cache a list of transcriptions for key, evicting old entries if needed."""
+        value = json.dumps(trans)
+        with self.lock, self.conn:
+            # the first write starts the transaction, so the replaced size is current
+            self.conn.execute('UPDATE meta SET size = size + ? - COALESCE('
+                              '(SELECT size FROM entries WHERE key = ?), 0)', (len(value), key))
+            self.conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                              (key, value, len(value), time()))
+            excess = self.conn.execute('SELECT size FROM meta').fetchone()[0] - self.max_size
+            if excess > 0:
+                evicted = []
+                freed = 0
+                for old_key, size in self.conn.execute(
+                        'SELECT key, size FROM entries ORDER BY used'):
+                    if freed >= excess:
+                        break
+                    evicted.append((old_key,))
+                    freed += size
+                self.conn.executemany('DELETE FROM entries WHERE key = ?', evicted)
+                self.conn.execute('UPDATE meta SET size = size - ?', (freed,))
+                LOG.debug('Evicted %s cached transcriptions', len(evicted))
+
+    def close(self):
+        """Close the database."""
+        self.conn.close()
+
+
+class Audio(object):
+    """Class representing a PCM WAV file, mapped into memory.
+
+    Syntax:
+        with Audio(path) as audio:
+            content = audio.read(start_sample, end_sample)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file_ = open(path, 'rb')
+        self.data = mmap.mmap(self.file_.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:4] != b'RIFF' or self.data[8:12] != b'WAVE':
+            raise ValueError('Not a WAV file: {}'.format(path))
+
+        # walk the chunks for the format and the samples
+        self.offset = None
+        pos = 12
+        while pos + 8 <= len(self.data):
+            chunk_id = self.data[pos:pos + 4]
+            size = struct.unpack('<I', self.data[pos + 4:pos + 8])[0]
+            if chunk_id == b'fmt ':
+                (_, self.channels, self.sample_rate, _, self.block_align,
+                 self.bits_per_sample) = struct.unpack('<HHIIHH', self.data[pos + 8:pos + 24])
+            elif chunk_id == b'data':
+                self.offset = pos + 8
+                self.size = min(size, len(self.data) - self.offset)
+                break
+            pos += 8 + size + size % 2
+        if self.offset is None:
+            raise ValueError('No samples in WAV file: {}'.format(path))
+        self.nsamples = self.size // self.block_align
+
+    def read(self, start, end):
+        """Return the PCM bytes of samples start to end."""
+        start = self.offset + max(0, start) * self.block_align
+        end = self.offset + min(end, self.nsamples) * self.block_align
+        return self.data[start:max(start, end)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        """Unmap and close the file."""
+        self.data.close()
+        self.file_.close()
+
 
 def seg_to_dict(diarize_file, temp_dir, temp_id):
     """Parse segment file to python-friendly structure.
@@ -75,14 +326,18 @@ def seg_to_dict(diarize_file, temp_dir, temp_id):
     return diarize_dict
 
 
-def dict_to_wav(diarize_dict, audio_file, temp_dir, temp_id):
-    """Split resampled wav file into segments based on seg_to_dict.
+def dict_to_wav(diarize_dict, audio, temp_dir, temp_id, debug=False):
+    """Find the samples of each segment from seg_to_dict in the audio.
+
+    The sample range [start, end] is appended to each value. With debug, the
+    segments are also written to temp WAV files.
 
     Arguments:
         diarize_dict: dict - diarize data structure from seg_to_dict
-        audio_file: str - path to resampled wav file
+        audio: Audio - resampled wav file
         temp_dir: str - path to temp folder
         temp_id: str - unique id to append to temp file names
+        debug: bool - write the segments to temp WAV files
     """
     # complete check using temp file
     # if completed, deserialize to diarize_dict; else start process
@@ -98,16 +353,18 @@ def dict_to_wav(diarize_dict, audio_file, temp_dir, temp_id):
         sorted_keys = sorted([x for x in diarize_dict.keys()])
         for key in sorted_keys:
             value = diarize_dict[key]
-            diar_part_file = os.path.join(
-                temp_dir, '{}_{}-{}.wav'.format(temp_id, count, value[0]))
-            part_dur = Decimal(value[2]) - Decimal(value[1])
-            inputs = {
-                audio_file: '-ss {} -t {}'.format(value[1], str(part_dur))}
-            outputs = {diar_part_file: None}
-            fnull = open(os.devnull, 'w')
-            FFmpeg(inputs=inputs, outputs=outputs).run(
-                stdout=fnull, stderr=fnull)
-            diarize_dict[key] = value + [diar_part_file]
+            samples = [int(Decimal(value[1]) * audio.sample_rate),
+                       int(Decimal(value[2]) * audio.sample_rate)]
+            if debug:
+                diar_part_file = os.path.join(
+                    temp_dir, '{}_{}-{}.wav'.format(temp_id, count, value[0]))
+                file_ = wave.open(diar_part_file, 'wb')
+                file_.setnchannels(audio.channels)
+                file_.setsampwidth(audio.bits_per_sample // 8)
+                file_.setframerate(audio.sample_rate)
+                file_.writeframes(audio.read(*samples))
+                file_.close()
+            diarize_dict[key] = value + [samples]
             count += 1
         with open(temp_dict_to_wav, 'w') as file_out:
             json.dump(diarize_dict, file_out, sort_keys=True, indent=4)
@@ -115,14 +372,260 @@ def dict_to_wav(diarize_dict, audio_file, temp_dir, temp_id):
     return diarize_dict
 
 
-def wav_to_trans(diarize_dict, speech_client, temp_dir, temp_id):
-    """Transcribe segment by segment.
+def split_points(audio, start, end):
+    """Return the samples a long segment is split at, at low-energy points.
+
+    Each chunk ends in the quietest window of the last SPLIT_SEARCH seconds
+    before MAX_REQUEST seconds of audio.
+
+    Arguments:
+        audio: Audio - audio the segment samples are read from
+        start: int - first sample of the segment
+        end: int - last sample of the segment
+    """
+    max_len = MAX_REQUEST * audio.sample_rate
+    search = SPLIT_SEARCH * audio.sample_rate
+    window = int(SPLIT_WINDOW * audio.sample_rate)
+    width = audio.bits_per_sample // 8
+    points = []
+    pos = start
+    while end - pos > max_len:
+        windows = range(pos + max_len - search, pos + max_len - window + 1, window)
+        quietest = min(windows, key=lambda x: audioop.rms(audio.read(x, x + window), width))
+        pos = quietest + window // 2
+        points.append(pos)
+    return points
+
+
+def plan_requests(diarize_dict, audio=None):
+    """Group the segments from dict_to_wav into recognition requests.
+
+    A request is a list of parts (key, start, end, own_start, own_end): the
+    audio of a request is the samples start to end of each part in turn, and
+    words recognized between own_start and own_end belong to the segment key.
+    Adjacent short segments of the same speaker are packed into one request;
+    segments longer than MAX_REQUEST seconds are split into overlapping
+    requests at low-energy points.
+
+    Arguments:
+        diarize_dict: dict - diarize data structure from dict_to_wav
+        audio: Audio - audio the segment samples are read from
+    """
+    requests = []
+    packed = []
+    packed_len = 0
+    for key in sorted(diarize_dict.keys()):
+        value = diarize_dict[key]
+        if not isinstance(value[3], list):
+            # segment file from an earlier version of dict_to_wav
+            requests.append([(key, None, None, None, None)])
+            continue
+        start, end = value[3]
+        length = end - start
+        if packed:
+            last_key, _, last_end, _, _ = packed[-1]
+            if (diarize_dict[last_key][0] == value[0] and
+                    start - last_end <= PACK_GAP * audio.sample_rate and
+                    packed_len + length <= PACK_DURATION * audio.sample_rate):
+                packed.append((key, start, end, start, end))
+                packed_len += length
+                continue
+            requests.append(packed)
+            packed = []
+        if length > MAX_REQUEST * audio.sample_rate:
+            overlap = SPLIT_OVERLAP * audio.sample_rate
+            bounds = [start] + split_points(audio, start, end) + [end]
+            for own_start, own_end in zip(bounds[:-1], bounds[1:]):
+                requests.append([(key, max(start, own_start - overlap),
+                                  min(end, own_end + overlap), own_start, own_end)])
+        else:
+            packed = [(key, start, end, start, end)]
+            packed_len = length
+    if packed:
+        requests.append(packed)
+    return requests
+
+
+def encode(content, sample_rate, channels, encoding='linear16'):
+    """Encode LINEAR16 audio for upload, return the encoded audio.
+
+    Arguments:
+        content: str - LINEAR16 audio
+        sample_rate: int - sample rate of the audio
+        channels: int - number of channels of the audio
+        encoding: str - upload encoding, one of ENCODINGS
+    """
+    if encoding == 'flac':
+        buf = io.BytesIO()
+        data = np.frombuffer(content, dtype='<i2').reshape(-1, channels)
+        sf.write(buf, data, sample_rate, format='FLAC', subtype='PCM_16')
+        return buf.getvalue()
+    return content
+
+
+def recognize(content, sample_rate, duration, speech_client, governor, keys, encoding='linear16'):
+    """Recognize some audio, return the response or None if all attempts fail.
+
+    Arguments:
+        content: str - audio encoded by encode
+        sample_rate: int - sample rate of the audio
+        duration: float - duration of the audio in seconds
+        speech_client: google.cloud.speech.SpeechClient - GCS client
+        governor: Governor - rate governor shared by all workers on the host
+        keys: list - segment keys of the request, for logging
+        encoding: str - upload encoding, one of ENCODINGS
+    """
+    recognition_audio = types.RecognitionAudio(content=content)
+    config = types.RecognitionConfig(
+        encoding=ENCODINGS[encoding],
+        sample_rate_hertz=sample_rate,
+        language_code='en-US',
+        enable_word_time_offsets=True)
+
+    # exponential backoff in case it fails, quota errors slow down the governor instead
+    attempt = 1
+    quota_since = None
+    while attempt <= 5:
+        governor.wait(duration)
+        try:
+            return speech_client.recognize(config, recognition_audio)
+        except exceptions.TooManyRequests:
+            governor.throttle()
+            quota_since = quota_since or time()
+            if time() - quota_since > QUOTA_TIMEOUT:
+                attempt += 1
+            LOG.debug('Quota exceeded, retrying transcription for keys %s', keys)
+        except BaseException:
+            sleep(2**attempt + randint(0, 1000) / 1000)
+            LOG.debug('Retrying transcription for keys %s', keys)
+            attempt += 1
+    return None
+
+
+def transcribe(request, diarize_dict, speech_client, governor, temp_dir, temp_id, audio=None,
+               encoding='linear16', cache=None):
+    """Transcribe a request from plan_requests.
+
+    Return the transcription of its segments and the number of bytes uploaded.
+
+    Arguments:
+        request: list - request parts from plan_requests
+        diarize_dict: dict - diarize data structure from dict_to_wav
+        speech_client: google.cloud.speech.SpeechClient - GCS client
+        governor: Governor - rate governor shared by all workers on the host
+        temp_dir: str - path to temp folder
+        temp_id: str - unique id to append to temp file names
+        audio: Audio - audio the segment samples are read from
+        encoding: str - upload encoding, one of ENCODINGS
+        cache: TranscriptCache - transcriptions shared across files
+    """
+    keys = [part[0] for part in request]
+    whole = [part[1] is None or part[1:3] == part[3:5] for part in request]
+    tmps = dict()
+    for (key, _, _, own_start, _), is_whole in zip(request, whole):
+        if is_whole:
+            tmps[key] = os.path.join(temp_dir, '{}_{}'.format(temp_id, key))
+        else:
+            # chunk of a split segment
+            tmps[key] = os.path.join(temp_dir, '{}_{}_{}'.format(temp_id, key, own_start))
+
+    # complete check using temp files
+    if all(os.path.exists(tmp) for tmp in tmps.values()):
+        trans = dict()
+        for key in keys:
+            with open(tmps[key], 'r') as file_:
+                trans[key] = file_.read().strip()
+        LOG.debug('Transcription previously acquired for keys %s', keys)
+        return trans, 0
+
+    if request[0][1] is None:
+        # segment file from an earlier version of dict_to_wav
+        with io.open(diarize_dict[keys[0]][3], 'rb') as file_:
+            content = file_.read()
+        sample_rate = 16000
+        channels = 1
+        encoding = 'linear16'
+        layout = None
+    else:
+        content = b''.join(audio.read(part[1], part[2]) for part in request)
+        sample_rate = audio.sample_rate
+        channels = audio.channels
+        layout = [(end - start, own_start - start, own_end - start)
+                  for _, start, end, own_start, own_end in request]
+
+    # cache check using the audio and how its words are assigned to segments
+    if cache is not None:
+        cache_key = TranscriptCache.key(content, {
+            'language_code': 'en-US', 'sample_rate': sample_rate, 'channels': channels,
+            'layout': layout})
+        cached = cache.get(cache_key)
+        if cached is not None:
+            LOG.debug('Transcription found in cache for keys %s', keys)
+            for key, value in zip(keys, cached):
+                with open(tmps[key], 'w') as file_:
+                    file_.write(value)
+            return dict(zip(keys, cached)), 0
+
+    duration = float(len(content)) / (2 * channels) / sample_rate
+    if layout is not None:
+        content = encode(content, sample_rate, channels, encoding)
+    res = recognize(content, sample_rate, duration, speech_client, governor, keys, encoding)
+
+    # process and write results
+    trans = {key: '<unk>' for key in keys}
+    if res is None:
+        # fail all attempts
+        LOG.debug('Failed transcription for keys %s', keys)
+    elif not res.results:
+        # empty transcription
+        LOG.debug('Empty transcription for keys %s', keys)
+    elif len(request) == 1 and whole[0]:
+        # a whole segment: keep the transcription as is
+        result_list = [x.alternatives[0].transcript.strip()
+                       for x in res.results]
+        trans[keys[0]] = ' '.join(result_list).encode('utf-8')
+        LOG.debug('Transcription acquired for keys %s', keys)
+    else:
+        # assign each word to the part its middle falls in
+        words = dict()
+        for result in res.results:
+            for word in result.alternatives[0].words:
+                middle = (word.start_time.seconds + word.end_time.seconds +
+                          (word.start_time.nanos + word.end_time.nanos) * 1e-9) / 2
+                pos = int(middle * sample_rate)
+                for i, (key, start, end, own_start, own_end) in enumerate(request):
+                    if pos < end - start or i == len(request) - 1:
+                        if own_start <= start + pos < own_end:
+                            words.setdefault(key, []).append(word.word)
+                        break
+                    pos -= end - start
+        for key in words:
+            trans[key] = ' '.join(words[key]).encode('utf-8')
+        LOG.debug('Transcription acquired for keys %s', keys)
+    for key in keys:
+        with open(tmps[key], 'w') as file_:
+            file_.write(trans[key])
+    if cache is not None and res is not None:
+        cache.put(cache_key, [trans[key] for key in keys])
+    return trans, len(content)
+
+
+def wav_to_trans(diarize_dict, speech_client, temp_dir, temp_id, concurrency=1, governor=None,
+                 audio=None, encoding='linear16', cache=None):
+    """Transcribe the segments, request by request.
+
+    Up to concurrency requests are transcribed at once.
 
     Arguments:
         diarize_dict: dict - diarize data structure from dict_to_wav
         speech_client: google.cloud.speech.SpeechClient - GCS client
         temp_dir: str - path to temp folder
         temp_id: str - unique id to append to temp file names
+        concurrency: int - max number of requests in flight
+        governor: Governor - rate governor shared by all workers on the host
+        audio: Audio - audio the segment samples are read from
+        encoding: str - upload encoding, one of ENCODINGS
+        cache: TranscriptCache - transcriptions shared across files
     """
     # complete check using temp file
     # if completed, deserialize to diarize_dict; else start process
@@ -134,58 +637,28 @@ def wav_to_trans(diarize_dict, speech_client, temp_dir, temp_id):
             diarize_dict = {int(k): v for k, v in tmp.items()}
         LOG.debug('wav_to_trans operation previously completed')
     else:
-        sorted_keys = sorted([x for x in diarize_dict.keys()])
-        for key in sorted_keys:
-            value = diarize_dict[key]
-            tmp = os.path.join(temp_dir, '{}_{}'.format(temp_id, key))
-
-            # complete check using temp file
-            if os.path.exists(tmp):
-                with open(tmp, 'r') as file_:
-                    diarize_dict[key] = value + [file_.read().strip()]
-                LOG.debug('Transcription previously acquired for key %s', key)
-            else:
-                with io.open(value[3], 'rb') as file_:
-                    content = file_.read()
-                audio = types.RecognitionAudio(content=content)
-                config = types.RecognitionConfig(
-                    encoding=enums.RecognitionConfig.AudioEncoding.LINEAR16,
-                    sample_rate_hertz=16000,
-                    language_code='en-US')
-
-                # exponential backoff in case it fails
-                attempt = 1
-                while attempt <= 5:
-                    try:
-                        res = speech_client.recognize(config, audio)
-                        break
-                    except BaseException:
-                        sleep(2**attempt + randint(0, 1000) / 1000)
-                        LOG.debug('Retrying transcription for key %s', key)
-                        attempt += 1
-
-                # process and write results
-                if attempt == 6:
-                    # fail all attempts
-                    new_value = value + ['<unk>']
-                    trans = '<unk>'
-                    LOG.debug('Failed transcription for key %s', key)
-                elif not res.results:
-                    # empty transcription
-                    new_value = value + ['<unk>']
-                    trans = '<unk>'
-                    LOG.debug('Empty transcription for key %s', key)
-                else:
-                    # get transcription
-                    result_list = [x.alternatives[0].transcript.strip()
-                                   for x in res.results]
-                    result_str = ' '.join(result_list)
-                    new_value = value + [result_str.encode('utf-8')]
-                    trans = result_str.encode('utf-8')
-                    LOG.debug('Transcription acquired for key %s', key)
-                diarize_dict[key] = new_value
-                with open(tmp, 'w') as file_:
-                    file_.write(trans)
+        if governor is None:
+            governor = Governor()
+        requests = plan_requests(diarize_dict, audio)
+        LOG.debug('Planned %s requests for %s segments', len(requests), len(diarize_dict))
+        pool = ThreadPool(concurrency)
+        try:
+            results = pool.map(lambda request: transcribe(
+                request, diarize_dict, speech_client, governor, temp_dir, temp_id, audio,
+                encoding, cache), requests)
+        finally:
+            pool.close()
+            pool.join()
+        LOG.info('Uploaded %s bytes (%s) for %s', sum(x[1] for x in results), encoding,
+                 temp_id)
+        trans = dict()
+        for result, _ in results:
+            for key, value in result.items():
+                # split segments: join the chunks in order
+                trans.setdefault(key, []).append(value)
+        for key in sorted(trans.keys()):
+            words = [x for x in trans[key] if x != '<unk>']
+            diarize_dict[key] = diarize_dict[key] + [' '.join(words) if words else '<unk>']
 
         with open(temp_wav_to_trans, 'w') as file_out:
             json.dump(diarize_dict, file_out, sort_keys=True, indent=4)
@@ -267,8 +740,27 @@ def trans_to_tg(diarize_dict, audio_file, temp_dir, temp_id, google_txt, google_
         LOG.debug('Written %s', google_textgrid)
 
 
-def google(process_id, file_id):
-    """Transcribe a file_id using Google Cloud Speech API."""
+def google(process_id, file_id, concurrency=1, debug=False, encoding='linear16', cache=True,
+           endpoint=None, requests_per_minute=REQUESTS_PER_MINUTE,
+           audio_per_minute=AUDIO_PER_MINUTE):
+    """Transcribe a file_id using Google Cloud Speech API.
+
+    Arguments:
+        process_id: str - process id
+        file_id: str - file id
+        concurrency: int - max number of requests in flight
+        debug: bool - write the segments to temp WAV files
+        encoding: str - upload encoding, one of ENCODINGS
+        cache: bool - share transcriptions across files through CACHE_FILE
+        endpoint: str - host:port of a plaintext Speech API, e.g. utils/google_mock.py;
+            defaults to the GOOGLE_SPEECH_ENDPOINT environment variable
+        requests_per_minute: int - request quota, over all workers on the host
+        audio_per_minute: int - audio quota in seconds, over all workers on the host
+    """
+    if encoding == 'flac' and sf is None:
+        LOG.warning('FLAC encoding needs numpy and soundfile, uploading LINEAR16')
+        encoding = 'linear16'
+
     # init paths
     working_dir = os.path.join(DATA_DIR, process_id, file_id)
     resample_dir = os.path.join(working_dir, 'resample/')
@@ -293,68 +785,109 @@ def google(process_id, file_id):
     # init google api
     json_key = os.path.join(CUR_DIR, 'key.json')
     os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = json_key
-    client = speech.SpeechClient()
-
-    # operations
-    # case 1: only one resampled file and one diarization file
-    if resample_count == diarize_count == 1:
-        LOG.debug('Transcribing single audio stream...')
-        google_txt = os.path.join(transcribe_dir, '{}.txt'.format(file_id))
-        google_textgrid = os.path.join(
-            transcribe_dir, '{}.TextGrid'.format(file_id))
-
-        # complete check
-        if os.path.exists(google_txt) and os.path.exists(google_textgrid):
-            LOG.debug('Previously transcribed %s, %s',
-                      google_txt, google_textgrid)
-        else:
-            temp_id = file_id[:8] + '0'
-            audio_file = os.path.join(
-                resample_dir, '{}.wav'.format(file_id))
-            diarize_file = os.path.join(diarize_dir, '{}.seg'.format(file_id))
-            diarize_dict = seg_to_dict(diarize_file, temp_dir, temp_id)
-            diarize_dict = dict_to_wav(
-                diarize_dict, audio_file, temp_dir, temp_id)
-            diarize_dict = wav_to_trans(
-                diarize_dict, client, temp_dir, temp_id)
-            trans_to_tg(diarize_dict, audio_file, temp_dir,
-                        temp_id, google_txt, google_textgrid)
-
-    # case 2: multiple vad files and diarization files
-    elif vad_count - diarize_count == 1 and diarize_count > 1:
-        LOG.debug('Transcribing multi-channel recording...')
-        # make sure the filenames are the same throughout
-        vad_names = sorted([os.path.splitext(i)[0] for i in os.listdir(
-            vad_dir) if i != '{}.wav'.format(file_id)])
-        diarize_names = sorted([os.path.splitext(j)[0]
-                                for j in os.listdir(diarize_dir)])
-        if vad_names == diarize_names:
-            for i in range(diarize_count):
-                google_txt = os.path.join(
-                    transcribe_dir, '{}.txt'.format(vad_names[i]))
-                google_textgrid = os.path.join(
-                    transcribe_dir, '{}.TextGrid'.format(vad_names[i]))
-
-                # complete check
-                if os.path.exists(google_txt) and os.path.exists(google_textgrid):
-                    LOG.debug('Previously transcribed %s, %s',
-                              google_txt, google_textgrid)
-                else:
-                    temp_id = file_id[:8] + str(i)
-                    audio_file = os.path.join(
-                        vad_dir, '{}.wav'.format(vad_names[i]))
-                    diarize_file = os.path.join(
-                        diarize_dir, '{}.seg'.format(vad_names[i]))
-                    diarize_dict = seg_to_dict(diarize_file, temp_dir, temp_id)
+    endpoint = endpoint or os.environ.get('GOOGLE_SPEECH_ENDPOINT')
+    if endpoint:
+        LOG.debug('Using Speech API at %s', endpoint)
+        client = speech.SpeechClient(channel=grpc.insecure_channel(endpoint))
+    else:
+        client = speech.SpeechClient()
+    governor = Governor(requests_per_minute, audio_per_minute)
+    cache = TranscriptCache() if cache else None
+
+    try:
+        # operations
+        # case 1: only one resampled file and one diarization file
+        if resample_count == diarize_count == 1:
+            LOG.debug('Transcribing single audio stream...')
+            google_txt = os.path.join(transcribe_dir, '{}.txt'.format(file_id))
+            google_textgrid = os.path.join(
+                transcribe_dir, '{}.TextGrid'.format(file_id))
+
+            # complete check
+            if os.path.exists(google_txt) and os.path.exists(google_textgrid):
+                LOG.debug('Previously transcribed %s, %s',
+                          google_txt, google_textgrid)
+            else:
+                temp_id = file_id[:8] + '0'
+                audio_file = os.path.join(
+                    resample_dir, '{}.wav'.format(file_id))
+                diarize_file = os.path.join(diarize_dir, '{}.seg'.format(file_id))
+                diarize_dict = seg_to_dict(diarize_file, temp_dir, temp_id)
+                with Audio(audio_file) as audio:
                     diarize_dict = dict_to_wav(
-                        diarize_dict, audio_file, temp_dir, temp_id)
+                        diarize_dict, audio, temp_dir, temp_id, debug)
                     diarize_dict = wav_to_trans(
-                        diarize_dict, client, temp_dir, temp_id)
-                    trans_to_tg(diarize_dict, audio_file, temp_dir,
-                                temp_id, google_txt, google_textgrid)
-        else:
-            LOG.debug('Invalid vad inputs for %s', file_id)
+                        diarize_dict, client, temp_dir, temp_id, concurrency, governor,
+                        audio, encoding, cache)
+                trans_to_tg(diarize_dict, audio_file, temp_dir,
+                            temp_id, google_txt, google_textgrid)
+
+        # case 2: multiple vad files and diarization files
+        elif vad_count - diarize_count == 1 and diarize_count > 1:
+            LOG.debug('Transcribing multi-channel recording...')
+            # make sure the filenames are the same throughout
+            vad_names = sorted([os.path.splitext(i)[0] for i in os.listdir(
+                vad_dir) if i != '{}.wav'.format(file_id)])
+            diarize_names = sorted([os.path.splitext(j)[0]
+                                    for j in os.listdir(diarize_dir)])
+            if vad_names == diarize_names:
+                for i in range(diarize_count):
+                    google_txt = os.path.join(
+                        transcribe_dir, '{}.txt'.format(vad_names[i]))
+                    google_textgrid = os.path.join(
+                        transcribe_dir, '{}.TextGrid'.format(vad_names[i]))
+
+                    # complete check
+                    if os.path.exists(google_txt) and os.path.exists(google_textgrid):
+                        LOG.debug('Previously transcribed %s, %s',
+                                  google_txt, google_textgrid)
+                    else:
+                        temp_id = file_id[:8] + str(i)
+                        audio_file = os.path.join(
+                            vad_dir, '{}.wav'.format(vad_names[i]))
+                        diarize_file = os.path.join(
+                            diarize_dir, '{}.seg'.format(vad_names[i]))
+                        diarize_dict = seg_to_dict(diarize_file, temp_dir, temp_id)
+                        with Audio(audio_file) as audio:
+                            diarize_dict = dict_to_wav(
+                                diarize_dict, audio, temp_dir, temp_id, debug)
+                            diarize_dict = wav_to_trans(
+                                diarize_dict, client, temp_dir, temp_id, concurrency,
+                                governor, audio, encoding, cache)
+                        trans_to_tg(diarize_dict, audio_file, temp_dir,
+                                    temp_id, google_txt, google_textgrid)
+            else:
+                LOG.debug('Invalid vad inputs for %s', file_id)
+    finally:
+        if cache is not None:
+            cache.close()
 
 
 if __name__ == '__main__':
-    google(sys.argv[1], sys.argv[2])
+    ARG_PARSER = argparse.ArgumentParser(
+        description='Transcribe a file_id using Google Cloud Speech API.')
+    ARG_PARSER.add_argument('process_id', help='process id')
+    ARG_PARSER.add_argument('file_id', help='file id')
+    ARG_PARSER.add_argument('-c', '--concurrency', metavar='N', type=int, default=1,
+                            help='max number of requests in flight')
+    ARG_PARSER.add_argument('-d', '--debug', action='store_true',
+                            help='write the segments to temp WAV files')
+    ARG_PARSER.add_argument('-e', '--encoding', choices=sorted(ENCODINGS.keys()),
+                            default='linear16', help='upload encoding, default linear16')
+    ARG_PARSER.add_argument('--no-cache', action='store_true',
+                            help='do not share transcriptions across files')
+    ARG_PARSER.add_argument('--endpoint', metavar='HOST:PORT',
+                            help='plaintext Speech API to use instead of Google')
+    ARG_PARSER.add_argument('--requests-per-minute', metavar='N', type=int,
+                            default=REQUESTS_PER_MINUTE,
+                            help='request quota, over all workers on the host, default {}'.format(
+                                REQUESTS_PER_MINUTE))
+    ARG_PARSER.add_argument('--audio-per-minute', metavar='SECONDS', type=int,
+                            default=AUDIO_PER_MINUTE,
+                            help='audio quota, over all workers on the host, default {}'.format(
+                                AUDIO_PER_MINUTE))
+    ARGS = ARG_PARSER.parse_args()
+    google(ARGS.process_id, ARGS.file_id, concurrency=ARGS.concurrency, debug=ARGS.debug,
+           encoding=ARGS.encoding, cache=not ARGS.no_cache, endpoint=ARGS.endpoint,
+           requests_per_minute=ARGS.requests_per_minute,
+           audio_per_minute=ARGS.audio_per_minute)
@@ -8,19 +8,20 @@ Requires:
 Perform voice activity detection (VAD) on a multi-channel recording into /vad
 """
 
+import argparse
+import heapq
 import logging
 import math
 import os
-import random
 import sys
 from copy import deepcopy
+from multiprocessing import Pool
 
 import numpy as np
 import scipy.fftpack
 import scipy.interpolate
 import scipy.signal
 import soundfile as sf
-from ffmpy import FFmpeg
 
 CUR_DIR = os.path.dirname(os.path.realpath(__file__))
 ROOT_DIR = os.path.dirname(os.path.dirname(CUR_DIR))
@@ -36,6 +37,13 @@ LOG.propagate = False
 LOG.addHandler(LOG_H)
 LOG.setLevel(logging.DEBUG)
 
+PITCH_BLOCK = 1024  # frames per block in batch_peridoc_pitch_count_fast
+MEDIAN_MAX_LABELS = 16  # max distinct values for the counting median_filter
+DC_FILTER = ([0.999, -0.999], [1, -0.999])  # (b, a) of the DC removal filter
+PRE_EMPHASIS = ([1, -0.97], [1])  # (b, a) of the pre-emphasis filter
+STREAM_REFINE_BACK = 500  # frames before each frame used to refine a streamed VAD
+STREAM_REFINE_AHEAD = 10  # frames after each frame used to refine a streamed VAD
+
 
 class VAD(object):
     """Class representing VAD values."""
@@ -64,135 +72,160 @@ class Seg(object):
         self.label = []
 
 
-def cal_power_sum_seg(audio, sample_rate):
-    """Calculate power sum of a segment."""
+def frame_signal(signal, flength, hsize, nframes):
+    """Return a read-only view of overlapping frames of a signal.
+
+    Arguments:
+        signal: np.ndarray - 1-D signal
+        flength: int - number of samples per frame
+        hsize: int - number of samples between frame starts
+        nframes: int - number of frames
+    Returns:
+        frames: np.ndarray - (nframes, flength) view into signal
+    """
+    signal = np.ascontiguousarray(signal)
+    stride = signal.strides[0]
+    return np.lib.stride_tricks.as_strided(
+        signal, shape=(nframes, flength), strides=(hsize * stride, stride), writeable=False)
+
+
+def rfft_power(frames, nfft):
+    """Return the power spectrum (bins 0..nfft/2) of each row of frames.
+
+    Arguments:
+        frames: np.ndarray - (nframes, flength) array of frames
+        nfft: int - FFT length (even), frames are zero-padded to this length
+    """
+    # fftpack packs the spectrum as [Re(0), Re(1), Im(1), ..., Re(nfft/2)]
+    spec = scipy.fftpack.rfft(frames, nfft, axis=1)
+    power = np.empty((spec.shape[0], nfft // 2 + 1), dtype=spec.dtype)
+    power[:, 0] = np.square(spec[:, 0])
+    power[:, 1:-1] = np.square(spec[:, 1:-1:2]) + np.square(spec[:, 2:-1:2])
+    power[:, -1] = np.square(spec[:, -1])
+    return power
+
+
+def cal_power_sum_seg(audio, sample_rate, rng=np.random):
+    """Calculate power sum of a segment, in the precision of audio."""
     flength = int(sample_rate * 0.025)
     hsize = int(sample_rate * 0.01)
     audio_len = len(audio)
+    dtype = audio.dtype
 
     # dither the speech signal
-    for i in range(audio_len):
-        audio[i] = audio[i] + np.random.randn() / (pow(2, 32))
+    audio = audio + (rng.randn(audio_len) / (pow(2, 32))).astype(dtype)
 
     # DC removal
     audio = scipy.signal.lfilter(
-        np.array([0.999, -0.999]), np.array([1, -0.999]), audio)
+        np.array(DC_FILTER[0], dtype=dtype), np.array(DC_FILTER[1], dtype=dtype), audio)
 
     # pre-emphasis
-    tmp_audio = np.zeros(audio_len)
-    for i in range(1, audio_len):
-        tmp_audio[i] = audio[i] - 0.97 * audio[i - 1]
-    tmp_audio[0] = audio[0]
-    audio = tmp_audio
-
-    # perform FFT
-    num_frame = int(math.floor((audio_len - flength) / hsize + 1))
-    spec = np.zeros((257, num_frame), dtype=np.complex)
-    for i in range(num_frame):
-        frame_dat = audio[i * hsize: i * hsize + flength]
-        frame_dat = frame_dat * np.hamming(flength)
-        result = scipy.fftpack.fft(frame_dat, 512)
-        result = result[0:result.size // 2 + 1]
-        spec[:, i] = result
-    tmp = np.multiply(spec, np.conjugate(spec))
-    power = tmp.real
-    power_sum = power.sum(axis=0)
+    audio = scipy.signal.lfilter(
+        np.array(PRE_EMPHASIS[0], dtype=dtype), np.array(PRE_EMPHASIS[1], dtype=dtype), audio)
+
+    power_sum = frame_power_sum(audio, flength, hsize)
 
     LOG.debug('cal_power_sum_seg operation completed')
     return power_sum
 
 
+def frame_power_sum(audio, flength, hsize):
+    """Return the power sum of each complete frame of a filtered signal.
+
+    Arguments:
+        audio: np.ndarray - 1-D filtered signal, at least flength long
+        flength: int - number of samples per frame
+        hsize: int - number of samples between frame starts
+    """
+    # perform FFT on all frames at once
+    num_frame = (len(audio) - flength) // hsize + 1
+    frames = frame_signal(audio, flength, hsize, num_frame) * \
+        np.hamming(flength).astype(audio.dtype)
+    return rfft_power(frames, 512).sum(axis=1)
+
+
+def pitch_bin_table(bin_width, pitch_idx_range, beam_width=2):
+    """Return the spectrum bins summed for each pitch candidate and harmonic.
+
+    Arguments:
+        bin_width: float - width of a spectrum bin (Hz)
+        pitch_idx_range: int - number of pitch candidates, from 80 Hz
+        beam_width: int - half-width of the band around each harmonic
+    Returns:
+        peak_bins, trough_bins: np.ndarray - (pitch_idx_range, 6, 2 * beam_width + 1)
+            bin indices of the bands around harmonics 2-7 of each pitch candidate,
+            and around the troughs half a pitch above them
+    """
+    # pitch_range_lower = 80
+    pitch_val = np.floor(((80 / bin_width) + np.arange(pitch_idx_range)) * bin_width)
+    # number of harmonics, skipping the first harmonics bcos very noisy!!!
+    idx = np.floor(np.outer(pitch_val, np.arange(2, 8)) / bin_width)
+    idx_trough = np.floor(idx + (pitch_val / (2 * bin_width))[:, np.newaxis])
+    band = np.arange(-beam_width - 1, beam_width)
+    peak_bins = idx.astype(np.int)[:, :, np.newaxis] + band
+    trough_bins = idx_trough.astype(np.int)[:, :, np.newaxis] + band
+    return peak_bins, trough_bins
+
+
 def batch_peridoc_pitch_count_fast(test_wave, sample_rate, nframe,
-                                   nsample_per_frame, nsample_forward):
-    """Return features from audio."""
-    x_start = 0
-    x_end = nsample_per_frame
-    act_frame_x = np.zeros((nsample_per_frame * 2, nframe))  # A matrix
-    for j in range(nframe):
-        tmp_arr = np.concatenate(
-            [test_wave[x_start:x_end], np.zeros(x_end - x_start)])
-        act_frame_x[:, j] = tmp_arr
-        x_start = x_start + nsample_forward
-        x_end = x_end + nsample_forward
+                                   nsample_per_frame, nsample_forward, rng=np.random):
+    """Return features from audio.
 
-    frame_size, nfr = act_frame_x.shape
-    bin_width = sample_rate / frame_size
-    hamm_frame = np.hamming(frame_size)
+    Frames are processed in blocks of PITCH_BLOCK, to bound memory usage, and
+    in the precision of test_wave.
+    """
+    dtype = test_wave.dtype
+    frame_size = nsample_per_frame * 2  # frames are zero-padded to twice their length
+    bin_width = sample_rate // frame_size
+    hamm_frame = np.hamming(frame_size).astype(dtype)
     hpfreq_upper = 800
-    n_hpfreq_upper_bin = int(math.ceil(hpfreq_upper / bin_width))
+    n_hpfreq_upper_bin = hpfreq_upper // bin_width
+    n_max_bin = 2 * hpfreq_upper // bin_width
 
     # frequency filtering
-    map_x = list(range(1, n_hpfreq_upper_bin + 1))  # [1:n_hpfreq_upper_bin]
-    map_x = 1.0 / n_hpfreq_upper_bin * np.array(map_x)  # map_x = map_x'
-    frame_x = np.zeros((nsample_per_frame * 2, nframe))
-    for i in range(nfr):
-        tmp_norm = np.linalg.norm(act_frame_x[:, i])
-        if tmp_norm == 0:
-            for j in range(frame_x.shape[0]):
-                frame_x[j, i] = random.random() * 0.00001
-            continue
-        frame_x[:, i] = act_frame_x[:, i] / np.linalg.norm(act_frame_x[:, i])
-        # so that signal level is NOT at play here!!!
-    frame_x_hamm = np.zeros((nsample_per_frame * 2, nframe))
-    for i in range(nfr):
-        frame_x_hamm[:, i] = np.multiply(frame_x[:, i], hamm_frame)
-    abs_fft_x = np.absolute(np.fft.fft(
-        frame_x_hamm, axis=0))  # PLEASE CHECK
-    for i in range(nfr):
-        abs_fft_x[:n_hpfreq_upper_bin, i] = np.multiply(
-            abs_fft_x[:n_hpfreq_upper_bin, i], map_x)
-    max_each_col = np.reciprocal(np.amax(
-        abs_fft_x[:2 * hpfreq_upper / bin_width, :], axis=0))
-    for i in range(frame_size):
-        abs_fft_x[i, :] = np.multiply(abs_fft_x[i, :], max_each_col)
-
-    # extract noise level from 2K-3K freq range
-    abs_fft_x = np.power(abs_fft_x, 1.2)  # abs_fft_x = abs_fft_x.^1.2
-    second_dim = abs_fft_x.shape[1]
-    bin_width = (sample_rate / (math.floor(frame_size / 2) * 2))
+    map_x = (1.0 / n_hpfreq_upper_bin *
+             np.arange(1, n_hpfreq_upper_bin + 1)).astype(dtype)
+
+    # bins around the harmonics of each pitch candidate
+    bin_width = sample_rate / (math.floor(frame_size / 2) * 2)
     # pitch_range_lower = 80, pitch_range_upper = 250
     pitch_idx_range = int(math.ceil(250 - 80) / bin_width)
-    val_hist_peak = np.zeros((second_dim, pitch_idx_range))
-    val_hist_trough = np.zeros((second_dim, pitch_idx_range))
-    sum_peak_val = np.zeros((second_dim, pitch_idx_range, 6))
-    sum_trough_val = np.zeros((second_dim, pitch_idx_range, 6))
-    beam_width = 2
-
-    for i in range(pitch_idx_range):
-        # pitch_range_lower = 80
-        pitch_val = math.floor(((80 / bin_width) + i) * bin_width)
-        # number of harmonics, skipping the first harmonics bcos very noisy!!!
-        for j in range(1, 7):
-            # PLEASE CHECK
-            idx = int(math.floor(((j + 1) * pitch_val) / bin_width))
-            idx_trough = int(math.floor(idx + (pitch_val / (2 * bin_width))))
-            tmp_mat_pi = abs_fft_x[idx - beam_width - 1:idx + beam_width, :]
-            p_i = tmp_mat_pi.sum(axis=0)
-            tmp_mat_ti = abs_fft_x[idx_trough -
-                                   beam_width - 1:idx_trough + beam_width, :]
-            t_i = tmp_mat_ti.sum(axis=0)
-            sum_peak_val[:, i, j - 1] = p_i
-            sum_trough_val[:, i, j - 1] = t_i
-
-    sum_peak = sum_peak_val.sum(axis=2)
-    sum_trough = sum_trough_val.sum(axis=2)
-    val_hist_trough = np.power(sum_trough, 2)
-
-    for i in range(pitch_idx_range):
-        curr_sum_peak_val = sum_peak_val[:, i, :].squeeze().transpose()
-        curr_sum_trough_val = sum_trough_val[:,
-                                             i, :].squeeze().conj().transpose()
-        val_hist_peak[:, i] = np.power(sum_peak[:, i], 2) - \
-            np.var(curr_sum_peak_val, axis=0, ddof=1).transpose() - \
-            np.var(curr_sum_trough_val, axis=0, ddof=1).transpose()
-
-    val_hist_peak_conj_transp = val_hist_peak.conj().transpose()
-    vhp_max = val_hist_peak_conj_transp.max(0)
-    vhp_argmax = val_hist_peak_conj_transp.argmax(0)
-    vhp_2 = np.zeros(nfr)
-    for i in range(nfr):
-        vhp_2[i] = abs(val_hist_trough[i, vhp_argmax[i]])
-    val_feature = np.divide(vhp_max, vhp_2)
+    peak_bins, trough_bins = pitch_bin_table(bin_width, pitch_idx_range)
+    n_bins = max(n_max_bin, peak_bins.max() + 1, trough_bins.max() + 1)
+
+    frames = frame_signal(test_wave, nsample_per_frame, nsample_forward, nframe)
+    val_feature = np.zeros(nframe)
+    for start in range(0, nframe, PITCH_BLOCK):
+        stop = min(nframe, start + PITCH_BLOCK)
+        block = frames[start:stop]
+
+        # so that signal level is NOT at play here!!!
+        norms = np.linalg.norm(block, axis=1)
+        silent = norms == 0
+        norms[silent] = 1
+        abs_fft_x = np.sqrt(rfft_power(
+            block / norms[:, np.newaxis] * hamm_frame[:nsample_per_frame],
+            frame_size)[:, :n_bins])
+        if silent.any():
+            noise = (rng.random_sample((silent.sum(), frame_size)) * 0.00001).astype(dtype)
+            abs_fft_x[silent] = np.sqrt(rfft_power(
+                noise * hamm_frame, frame_size)[:, :n_bins])
+        abs_fft_x[:, :n_hpfreq_upper_bin] *= map_x
+        abs_fft_x *= np.reciprocal(abs_fft_x[:, :n_max_bin].max(axis=1))[:, np.newaxis]
+        abs_fft_x = np.power(abs_fft_x, 1.2)  # abs_fft_x = abs_fft_x.^1.2
+
+        # (frames, pitch candidates, harmonics) band sums
+        sum_peak_val = abs_fft_x[:, peak_bins].sum(axis=3)
+        sum_trough_val = abs_fft_x[:, trough_bins].sum(axis=3)
+        val_hist_trough = np.power(sum_trough_val.sum(axis=2), 2)
+        val_hist_peak = np.power(sum_peak_val.sum(axis=2), 2) - \
+            np.var(sum_peak_val, axis=2, ddof=1) - \
+            np.var(sum_trough_val, axis=2, ddof=1)
+
+        vhp_argmax = val_hist_peak.argmax(axis=1)
+        rows = np.arange(stop - start)
+        val_feature[start:stop] = np.divide(
+            val_hist_peak[rows, vhp_argmax], np.abs(val_hist_trough[rows, vhp_argmax]))
     return val_feature
 
 
@@ -241,7 +274,17 @@ def adapt_threshold(s_old, val):
     return s_new
 
 
-def combine_vad(audio, sample_rate):
+def vad_state():
+    """Return the initial VAD state for adapt_threshold."""
+    s_new = VAD()
+    s_new.frame_idx = 0
+    s_new.min_feature_val = 15
+    s_new.min_ratio_spnf = 2.5
+    s_new.th_offset = 10
+    return s_new
+
+
+def combine_vad(audio, sample_rate, rng=np.random):
     """Combine VAD values."""
     max_nsample_total = len(audio)
     frame_sztime = 0.1  # ?? msec frame Window
@@ -252,14 +295,10 @@ def combine_vad(audio, sample_rate):
     nframes = int(math.floor(
         (max_nsample_total - nsample_per_frame) * 1.0 / nsample_forward))
 
-    s_new = VAD()
-    s_new.frame_idx = 0
-    s_new.min_feature_val = 15
-    s_new.min_ratio_spnf = 2.5
-    s_new.th_offset = 10
+    s_new = vad_state()
 
     periodic_vad_val = batch_peridoc_pitch_count_fast(
-        audio, sample_rate, nframes, nsample_per_frame, nsample_forward)
+        audio, sample_rate, nframes, nsample_per_frame, nsample_forward, rng)
     x_start = 0
     x_end = nsample_per_frame
 
@@ -276,14 +315,177 @@ def combine_vad(audio, sample_rate):
     return vad_flag
 
 
+def sliding_median(values, win_len):
+    """Return the medians of all windows of win_len (odd) values, in O(log win_len) each.
+
+    The smaller half of the window is kept in a max-heap (of negated values),
+    the larger half in a min-heap. Values leaving the window are deleted once
+    they reach the top of their heap.
+
+    Arguments:
+        values: list - numbers
+        win_len: int - window length, odd
+    """
+    low = [-x for x in values[:win_len]]
+    heapq.heapify(low)
+    high = []
+    for _ in range(win_len // 2):
+        heapq.heappush(high, -heapq.heappop(low))
+    deleted = {}  # value -> number of pending deletions
+
+    def prune(heap, sign):
+        """Pop the deleted values at the top of a heap."""
+        while heap and deleted.get(sign * heap[0]):
+            deleted[sign * heap[0]] -= 1
+            heapq.heappop(heap)
+
+    medians = [-low[0]]
+    for i in range(win_len, len(values)):
+        out, in_ = values[i - win_len], values[i]
+        deleted[out] = deleted.get(out, 0) + 1
+        balance = -1 if out <= -low[0] else 1  # change of the size of low - high
+        if in_ <= -low[0]:
+            heapq.heappush(low, -in_)
+            balance += 1
+        else:
+            heapq.heappush(high, in_)
+            balance -= 1
+        if balance < 0:
+            heapq.heappush(low, -heapq.heappop(high))
+        elif balance > 0:
+            heapq.heappush(high, -heapq.heappop(low))
+        prune(low, -1)
+        prune(high, 1)
+        medians.append(-low[0])
+    return medians
+
+
 def median_filter(audio, filter_len):
-    """Perform a median filter on the audio."""
+    """Perform a median filter on the audio.
+
+    The window is 2 * ((filter_len - 1) / 2) + 1 values long, and the values
+    at both ends which have no full window are left unfiltered. Inputs with
+    few distinct values (channel ids, VAD flags) are filtered by counting
+    values in each window, other inputs with sliding_median(), in
+    O(n log filter_len) either way.
+    """
+    audio = np.asarray(audio)
     nframes = len(audio)
-    hlen = (filter_len - 1) / 2
-    audio_copy = deepcopy(audio)
-    for i in range(hlen, nframes - hlen):
-        audio_copy[i] = np.median(audio[i - hlen:i + hlen + 1])
-    return audio_copy
+    hlen = (filter_len - 1) // 2
+    win_len = 2 * hlen + 1
+    audio_filtered = audio.copy()
+    if nframes < win_len:
+        return audio_filtered
+
+    values = np.unique(audio)
+    if len(values) <= MEDIAN_MAX_LABELS:
+        # the median is the smallest value with more than hlen values
+        # in the window which are smaller than or equal to it
+        medians = np.empty(nframes - 2 * hlen, dtype=audio.dtype)
+        found = np.zeros(nframes - 2 * hlen, dtype=np.bool)
+        for value in values:
+            count = np.concatenate([[0], np.cumsum(audio <= value)])
+            is_median = (count[win_len:] - count[:-win_len] > hlen) & ~found
+            medians[is_median] = value
+            found |= is_median
+        audio_filtered[hlen:nframes - hlen] = medians
+    else:
+        audio_filtered[hlen:nframes - hlen] = sliding_median(audio.tolist(), win_len)
+    return audio_filtered
+
+
+def normalize_power(power_sum):
+    """Return power sums normalised by the sum over all channels of each frame.
+
+    Arguments:
+        power_sum: np.ndarray - (channels, frames) power sums
+    """
+    return power_sum / np.sum(power_sum, axis=0)
+
+
+def dominant_channels(power_sum_norm):
+    """Return the channel (from 1) with the most power in each frame.
+
+    Arguments:
+        power_sum_norm: np.ndarray - (channels, frames) normalised power sums
+    """
+    return np.argmax(power_sum_norm, axis=0) + 1
+
+
+class StreamFilter(object):
+    """Class for applying a windowed filter to a stream of frames.
+
+    func(values) is applied to the frames as if the whole stream was
+    filtered at once, provided that each output frame only depends on the
+    lookback frames before and the lookahead frames after it. A frame is only
+    filtered once the frames of its window have been pushed, so the output
+    lags the input by lookahead frames. The last frames are filtered on flush().
+
+    Syntax:
+        stream = StreamFilter(func, lookback, lookahead)
+        values = stream.push(values)
+        values = stream.flush()
+    """
+
+    def __init__(self, func, lookback, lookahead):
+        self.func = func
+        self.lookback = lookback
+        self.lookahead = lookahead
+        self.history = None  # from frame done - lookback
+        self.done = 0
+        self.nframes = 0
+
+    def filter(self, stop):
+        """Return filtered frames up to stop, and drop old history."""
+        if stop <= self.done:
+            return self.history[:0]
+        start = max(0, self.done - self.lookback)
+        values = self.func(self.history)[self.done - start:stop - start]
+        self.done = stop
+        self.history = self.history[max(0, stop - self.lookback) - start:]
+        return values
+
+    def push(self, values):
+        """Push frames, return the newly filtered frames."""
+        if self.history is None:
+            self.history = values
+        else:
+            self.history = np.concatenate([self.history, values])
+        self.nframes += len(values)
+        return self.filter(max(self.done, self.nframes - self.lookahead))
+
+    def flush(self):
+        """Return all remaining filtered frames."""
+        if self.history is None:
+            return np.empty(0)
+        return self.filter(self.nframes)
+
+
+class ChannelDominance(object):
+    """Class for tracking the dominant channel of a stream of frames.
+
+    The dominant channels are smoothed with median_filter as if the whole
+    stream was filtered at once, so labels lag the input by
+    (filter_len - 1) / 2 frames. The last frames are labelled on flush().
+
+    Syntax:
+        dominance = ChannelDominance(filter_len)
+        labels = dominance.push(power_sum)
+        labels = dominance.flush()
+    """
+
+    def __init__(self, filter_len=51):
+        hlen = (filter_len - 1) // 2
+        self.stream = StreamFilter(
+            lambda labels: median_filter(labels, filter_len), hlen, hlen)
+
+    def push(self, power_sum):
+        """Push (channels, frames) power sums, return the newly labelled frames."""
+        return self.stream.push(dominant_channels(normalize_power(power_sum)))
+
+    def flush(self):
+        """Return the labels of all remaining frames."""
+        return self.stream.flush().astype(np.int)
 
 
 def post_process_vad(vad, buffer_len, filter_len=40):
@@ -352,74 +554,68 @@ def seg2label(seg, nframes):
     return label
 
 
-def write_seg(seg, nchans, posfix, temp_dir):
-    """Write segment info to temp files."""
-    n_seg = len(seg.label)
-    seg_info = [[] for _ in range(nchans)]
-    for i in range(n_seg):
-        if seg.label[i] > 0:
-            label = 'chan{} {} {} 1'.format(
-                seg.label[i], seg.start[i] * 0.01, seg.stop[i] * 0.01)
-            seg_info[seg.label[i] - 1].append(label)
+def speech_segments(seg):
+    """Return (channel, start frame, stop frame) of the speech segments of a seg structure."""
+    return np.array([(seg.label[i], seg.start[i], seg.stop[i])
+                     for i in range(len(seg.label)) if seg.label[i] > 0],
+                    dtype=np.int).reshape(-1, 3)
 
-    for i in range(nchans):
-        temp_file = os.path.join(
-            temp_dir, 'segment_chan{}_{}.txt'.format(i + 1, posfix))
-        with open(temp_file, 'w') as file_:
-            for j in range(len(seg_info[i])):
-                file_.write(seg_info[i][j] + '\n')
-
-
-def gen_final_vad(audio, sample_rate, postfix, nchannels, temp_dir):
-    """Generate final VAD and store in temp folder."""
-    power_sum = np.empty((0, 0), dtype=np.double)
-    nframes = -1
-    for i in range(len(audio)):
-        curr_power_sum = cal_power_sum_seg(audio[i, :], sample_rate)
-        if i == 0:
-            power_sum = np.empty((0, len(curr_power_sum)), dtype=np.double)
-            nframes = len(curr_power_sum)
-        power_sum = np.vstack([power_sum, curr_power_sum])
-
-    sum_all = np.sum(power_sum, axis=0)
-    power_sum_norm = np.zeros(power_sum.shape)
-    for i in range(nframes):
-        power_sum_norm[:i] = np.divide(power_sum[:i], sum_all)
-    for i in range(len(audio)):
-        temp_file = os.path.join(
-            temp_dir, 'power_sum_{}_chan_{}.txt'.format(postfix, i + 1))
-        np.savetxt(temp_file, power_sum_norm[i, :], fmt='%.3f')
+
+def channel_features(task):
+    """Calculate the VAD features of one channel in one segment.
+
+    Reads its own slice of the channel, so tasks can run in a process pool.
+
+    Arguments:
+        task: tuple - (file path, start sample, end sample, random seed, dtype)
+    """
+    in_file, sample_start, sample_end, seed, dtype = task
+    with sf.SoundFile(in_file) as file_:
+        file_.seek(sample_start)
+        audio = file_.read(sample_end - sample_start, dtype=dtype, fill_value=0)
+        sample_rate = file_.samplerate
+    return channel_vad(audio, sample_rate, np.random.RandomState(seed))
+
+
+def channel_vad(audio, sample_rate, rng=np.random):
+    """Calculate the power sums and post-processed pitch VAD of one channel.
+
+    The features are calculated in the precision of audio.
+    """
+    power_sum = cal_power_sum_seg(audio, sample_rate, rng)
+
+    curr_vad = combine_vad(audio, sample_rate, rng)
+    idx_arr = np.zeros(len(curr_vad), dtype=np.int)
+    for j in range(len(curr_vad)):
+        idx_arr[j] = j * 2
+    func = scipy.interpolate.interp1d(
+        idx_arr, curr_vad, kind='nearest', fill_value='extrapolate')
+    new_arr_idx = list(range(2 * len(curr_vad)))
+    curr_vad = func(new_arr_idx)
+    pitch_vad = post_process_vad(curr_vad, 20)
+
+    return power_sum, pitch_vad
+
+
+def gen_final_vad(power_sum, pitch_vad, postfix, temp_dir, debug=False):
+    """Generate final VAD.
+
+    Arguments:
+        power_sum: np.ndarray - (channels, frames) power sums
+        pitch_vad: np.ndarray - (channels, frames) post-processed pitch VAD
+        postfix: str - segment name for temp files
+        temp_dir: str - temp folder
+        debug: bool - write the intermediate VADs into temp folder
+    Returns:
+        spk_id_smooth_refined: np.ndarray - active channel of each frame (0 for none)
+        speech: np.ndarray - (segments, 3) channel, start and (inclusive) stop frames
+    """
+    nframes = power_sum.shape[1]
+    power_sum_norm = normalize_power(power_sum)
     LOG.debug('Finish normalising energy')
 
-    channels = np.argmax(power_sum_norm, axis=0)
-    for i in range(len(channels)):
-        channels[i] = channels[i] + 1
-    np.savetxt(os.path.join(
-        temp_dir, 'vad_energy_raw_{}.txt'.format(postfix)), channels, fmt='%d')
+    channels = dominant_channels(power_sum_norm)
     channels_smooth = median_filter(channels, 51)
-    np.savetxt(os.path.join(temp_dir, 'vad_energy_{}.txt'.format(
-        postfix)), channels_smooth, fmt='%d')
-
-    pitch_vad = np.empty((0, 0), dtype=np.int)
-    for i in range(nchannels):
-        comb_vad_flag = combine_vad(audio[i, :], sample_rate)
-        curr_vad = comb_vad_flag
-        idx_arr = np.zeros(len(curr_vad), dtype=np.int)
-        for j in range(len(curr_vad)):
-            idx_arr[j] = j * 2
-        func = scipy.interpolate.interp1d(
-            idx_arr, curr_vad, kind='nearest', fill_value='extrapolate')
-        new_arr_idx = list(range(2 * len(curr_vad)))
-        curr_vad = func(new_arr_idx)
-        curr_vad_post = post_process_vad(curr_vad, 20)
-        if i == 0:
-            pitch_vad = np.empty((0, len(curr_vad_post)), dtype=np.int)
-        pitch_vad = np.vstack([pitch_vad, curr_vad_post])
-
-    for i in range(pitch_vad.shape[0]):
-        temp_file = os.path.join(
-            temp_dir, 'vad_pitch_{}_channel{}.txt'.format(postfix, i + 1))
-        np.savetxt(temp_file, pitch_vad[i, :], fmt='%d')
 
     spk_id_seg = label2seg(channels_smooth)
     spk_id_seg_refined = deepcopy(spk_id_seg)
@@ -433,93 +629,111 @@ def gen_final_vad(audio, sample_rate, postfix, nchannels, temp_dir):
             continue
         if np.median(curr_pitch_vad) == 0:
             spk_id_seg_refined.label[i] = 0
-    write_seg(spk_id_seg_refined, len(audio), postfix, temp_dir)
+    speech = speech_segments(spk_id_seg_refined)
     spk_id_smooth_refined = seg2label(spk_id_seg_refined, nframes)
-    np.savetxt(os.path.join(temp_dir, 'vad_refined_{}.txt'.format(
-        postfix)), spk_id_smooth_refined, fmt='%d')
+    if debug:
+        temp_file = os.path.join(temp_dir, 'vad_{}.npz'.format(postfix))
+        np.savez_compressed(temp_file, power_sum=power_sum_norm, vad_energy_raw=channels,
+                            vad_energy=channels_smooth, vad_pitch=pitch_vad,
+                            vad_refined=spk_id_smooth_refined, speech=speech)
+        LOG.debug('Written %s', temp_file)
     LOG.debug('Finish processing segment %s', postfix)
 
-    return spk_id_smooth_refined
+    return spk_id_smooth_refined, speech
+
+
+def modify_signal(audio, spk_id_smooth_refined, hsize, flength, seed=0):
+    """Modify the audio signal in place, suppressing crosstalk.
 
+    Non-zero samples of a channel which are covered by any frame where the
+    channel is not active are replaced by random values below 1e-10, keeping
+    their sign.
 
-def modify_signal(tmp_audio, spk_id_smooth_refined, hsize, flength):
-    """Modify the audio signal."""
+    Arguments:
+        audio: np.ndarray - (channels, samples) audio, modified in place
+        spk_id_smooth_refined: np.ndarray - active channel of each frame (0 for none)
+        hsize: int - number of samples between frame starts
+        flength: int - number of samples per frame
+        seed: int - seed of the random values, for reproducible runs
+    """
     LOG.debug('Modifying the signal...')
-    audio = deepcopy(tmp_audio)
-    nsample = len(tmp_audio[0, :])
-
-    if audio.shape[0] == 0 or audio.shape[1] == 0:
-        LOG.debug('Wrong audio shape: %s,%s', audio.shape[0], audio.shape[1])
-    spk_id_smooth_refined_len = len(spk_id_smooth_refined)
-    for j in range(spk_id_smooth_refined_len):
-        active_channel = spk_id_smooth_refined[j]
-        start_frame = j * hsize
-        end_frame = min(start_frame + flength, nsample)
-
-        for i in range(len(tmp_audio)):
-            if i != active_channel - 1:
-                for k in range(start_frame, end_frame):
-                    if abs(audio[i, k]) == 0:
-                        continue
-                    audio[i, k] = audio[i, k] * \
-                        random.random() / (abs(audio[i, k]) * 10000000000)
+    nchans, nsample = audio.shape
+    if nchans == 0 or nsample == 0:
+        LOG.debug('Wrong audio shape: %s,%s', nchans, nsample)
+        return audio
+
+    # sample ranges of the frames
+    labels = np.asarray(spk_id_smooth_refined)
+    starts = np.arange(len(labels)) * hsize
+    labels = labels[starts < nsample]
+    starts = starts[starts < nsample]
+    ends = np.minimum(starts + flength, nsample)
+
+    # per-sample count of covering frames where each channel is inactive
+    mask = np.empty(audio.shape, dtype=np.bool)
+    for i in range(nchans):
+        inactive = labels != i + 1
+        edges = np.bincount(starts[inactive], minlength=nsample + 1) - \
+            np.bincount(ends[inactive], minlength=nsample + 1)
+        mask[i] = np.cumsum(edges[:nsample]) > 0
+    mask &= audio != 0
+
+    samples = audio[mask]
+    rng = np.random.RandomState(seed)
+    audio[mask] = samples * \
+        rng.random_sample(len(samples)) / (np.abs(samples) * 10000000000)
     return audio
 
 
-def combine_segment(channel_id, nsamples, nsegs, tolerance, discard_short_seg,
-                    length_per_seg, diarize_file, temp_dir):
-    """Write segments into diarization file."""
-    curr_start = 0
-    curr_end = 0
-    curr_seg = 0
+def combine_segment(channel_id, speech, nsamples, tolerance, discard_short_seg, hsize,
+                    diarize_file, temp_dir, debug_samples=False):
+    """Write segments into diarization file.
+
+    Speech segments less than tolerance frames apart are merged, then merged
+    segments shorter than discard_short_seg frames are dropped. As before,
+    the last merged segment is not written. With debug_samples, also write
+    the per-sample VAD of the channel into temp folder.
+
+    Arguments:
+        channel_id: int - channel, from 1
+        speech: np.ndarray - (segments, 2) sorted start and (inclusive) stop frames
+        nsamples: int - number of samples of the channel
+        tolerance: int - largest gap between merged segments, in frames
+        discard_short_seg: int - shortest merged segment written, in frames
+        hsize: int - number of samples between frame starts
+        diarize_file: str - path to diarization file
+        temp_dir: str - temp folder
+        debug_samples: bool - write the per-sample VAD into temp folder
+    """
+    starts = speech[:, 0]
+    stops = speech[:, 1]
+    if len(speech):
+        # a gap larger than tolerance starts a new merged segment
+        breaks = np.flatnonzero(starts[1:] - stops[:-1] > tolerance)
+        starts = starts[np.concatenate([[0], breaks + 1])]
+        stops = stops[np.concatenate([breaks, [len(stops) - 1]])]
+        keep = stops[:-1] - starts[:-1] >= discard_short_seg
+        starts = starts[:-1][keep]
+        stops = stops[:-1][keep]
+
     with open(diarize_file, 'w') as file_:
-        full_sample_based_vad = np.zeros(nsamples, dtype=np.double)
-        for i in range(nsegs):
-            temp_file = os.path.join(
-                temp_dir, 'segment_chan{}_seg{}.txt'.format(channel_id, i + 1))
-            with open(temp_file) as tmp:
-                lines = [x.strip() for x in tmp.readlines()]
-            for line in lines:
-                aseg = line.split(' ')
-                start = float(aseg[1]) + length_per_seg * i
-                end = float(aseg[2]) + length_per_seg * i
-                is_speech = aseg[3]
-                if is_speech == '1':  # Only care if aseg is a speech segment
-                    if curr_seg == 0:
-                        # Already finish the process of merging close segments
-                        # Now starting a new segment
-                        curr_seg = 1
-                        curr_end = end
-                        curr_start = start
-                    elif start - curr_end <= tolerance:
-                        # In the process of merging close segments
-                        # The segment aseg can be merged into the current segment
-                        curr_end = end
-                    elif (curr_end - curr_start) >= discard_short_seg:
-                        # The segment aseg is too far from the current segment
-                        # Write down the current segment and start new segment
-                        LOG.debug('Speech %s,%s', curr_start, curr_end)
-                        label = 'channel{} 1 {} {} U S U S{}'.format(channel_id, int(
-                            curr_start * 100), int((curr_end - curr_start) * 100), channel_id)
-                        file_.write(label + '\n')
-                        start_samp = int(curr_start * 100 * 160)
-                        end_samp = int(min(curr_end * 100 * 160, nsamples))
-                        for k in range(start_samp, end_samp):
-                            full_sample_based_vad[k] = 0.5 + random.random()
-                        curr_start = start
-                        curr_end = end
-                        curr_seg = 1
-                    else:
-                        # Segment is too short
-                        curr_start = start
-                        curr_end = end
-                        curr_seg = 1
+        for start, stop in zip(starts, stops):
+            file_.write('channel{} 1 {} {} U S U S{}\n'.format(
+                channel_id, start, stop - start, channel_id))
     LOG.debug('Written %s', diarize_file)
-    np.savetxt(os.path.join(temp_dir, 'final_sample_vad_chan{}'.format(
-        channel_id)), full_sample_based_vad, fmt='%.5f')
+
+    if debug_samples:
+        edges = np.zeros(nsamples + 1, dtype=np.int)
+        np.add.at(edges, np.minimum(starts * hsize, nsamples), 1)
+        np.add.at(edges, np.minimum(stops * hsize, nsamples), -1)
+        temp_file = os.path.join(
+            temp_dir, 'final_sample_vad_chan{}.npz'.format(channel_id))
+        np.savez_compressed(temp_file, vad=np.cumsum(edges[:-1]) > 0)
+        LOG.debug('Written %s', temp_file)
 
 
-def crosstalk_remover(process_id, file_id):
+def crosstalk_remover(process_id, file_id, workers=1, debug=False, debug_samples=False,
+                      precision='float64'):
     """Entry point for module.
 
     Remove crosstalk from multi-channel inputs.
@@ -527,6 +741,10 @@ def crosstalk_remover(process_id, file_id):
     Arguments:
         process_id: str - process id
         file_id: str - file id
+        workers: int - number of processes calculating channel features
+        debug: bool - write the intermediate VADs of each segment into temp/vad
+        debug_samples: bool - write the per-sample VAD of each channel into temp/vad
+        precision: str - floating point type of the processing, float64 or float32
     """
     # init paths
     working_dir = os.path.join(DATA_DIR, process_id, file_id)
@@ -539,15 +757,18 @@ def crosstalk_remover(process_id, file_id):
     if not os.path.exists(diarize_dir):
         os.makedirs(diarize_dir)
     temp_dir = os.path.join(working_dir, 'temp/vad')
-    if not os.path.exists(temp_dir):
+    if (debug or debug_samples) and not os.path.exists(temp_dir):
         os.makedirs(temp_dir)
 
     # define constants
-    tolerance = 0.5  # Merge 2 speech segments that have their gap smaller than this tolerance
-    discard_short_seg = 0.5  # Ignore speech segment that smaller than this value
-    audio_dat, sample_rate = sf.read(
-        os.path.join(resample_dir, resample_files[0]))
-    nsample = len(audio_dat)
+    # Merge 2 speech segments that have their gap (frames) smaller than this tolerance
+    tolerance = 50
+    discard_short_seg = 50  # Ignore speech segment (frames) that smaller than this value
+    in_files = [os.path.join(resample_dir, file_)
+                for file_ in resample_files]
+    info = sf.info(in_files[0])
+    sample_rate = info.samplerate
+    nsample = info.frames
     LOG.debug('Number of samples: %s', nsample)
     nframe_per_seg = 20000
     flength = int(sample_rate * 0.025)
@@ -555,55 +776,424 @@ def crosstalk_remover(process_id, file_id):
     nsample_per_seg = (nframe_per_seg - 1) * hsize + flength
     LOG.debug('Number of samples per segment: %s', nsample_per_seg)
 
-    # load all inputs into array
-    audio = np.empty((0, nsample), dtype=np.double)
-    for file_ in resample_files:
-        audio_dat, sample_rate = sf.read(os.path.join(resample_dir, file_))
-        audio = np.vstack([audio, audio_dat])
-
-    # perform operations
-    sample_start_frame = 0
-    sample_end_frame = min(nsample, sample_start_frame + nsample_per_seg)
-    seg_count = 1
-    while sample_start_frame < nsample:
-        LOG.debug('Segment %s, start sample = %s, end sample = %s',
-                  seg_count, sample_start_frame, sample_end_frame)
-        curr_seg_audio = audio[:, sample_start_frame:sample_end_frame]
-        spk_id_smooth_refined = gen_final_vad(
-            curr_seg_audio, sample_rate, 'seg' + str(seg_count), len(resample_files), temp_dir)
-        seg_count = seg_count + 1
-        audio[:, sample_start_frame:sample_end_frame] = modify_signal(
-            audio[:, sample_start_frame:sample_end_frame], spk_id_smooth_refined, hsize, flength)
-        sample_start_frame = sample_start_frame + nsample_per_seg
-        sample_end_frame = min(nsample, sample_end_frame + nsample_per_seg)
-
-    # write output files
-    i = 0
-    out_files = list()
-    for file_ in resample_files:
-        out_file = os.path.join(vad_dir, file_)
-        out_files.append(out_file)
-        sf.write(out_file, audio[i, :], sample_rate)
+    # channel features of all segments, in (segment, channel) order
+    seg_bounds = [(start, min(nsample, start + nsample_per_seg))
+                  for start in range(0, nsample, nsample_per_seg)]
+    tasks = [(in_file, start, end, seg * len(in_files) + chan, precision)
+             for seg, (start, end) in enumerate(seg_bounds)
+             for chan, in_file in enumerate(in_files)]
+    pool = None
+    if workers > 1:
+        pool = Pool(workers)
+        features = pool.imap(channel_features, tasks)
+    else:
+        features = (channel_features(task) for task in tasks)
+
+    # stream segments from inputs to outputs, one segment in memory at a time,
+    # with the mono mix of all channels unless the only channel is the mix
+    out_files = [os.path.join(vad_dir, file_) for file_ in resample_files]
+    mix_file = os.path.join(vad_dir, '{}.wav'.format(file_id))
+    if mix_file not in out_files:
+        out_files.append(mix_file)
+    readers = [sf.SoundFile(file_) for file_ in in_files]
+    writers = [sf.SoundFile(file_, 'w', sample_rate, 1)
+               for file_ in out_files]
+    speech = list()
+    try:
+        seg_count = 1
+        for sample_start_frame, sample_end_frame in seg_bounds:
+            LOG.debug('Segment %s, start sample = %s, end sample = %s',
+                      seg_count, sample_start_frame, sample_end_frame)
+            seg_features = [next(features) for _ in in_files]
+            spk_id_smooth_refined, seg_speech = gen_final_vad(
+                np.vstack([power_sum for power_sum, _ in seg_features]),
+                np.vstack([pitch_vad for _, pitch_vad in seg_features]),
+                'seg' + str(seg_count), temp_dir, debug)
+            curr_seg_audio = np.empty(
+                (len(readers), sample_end_frame - sample_start_frame), dtype=precision)
+            for i, reader in enumerate(readers):
+                reader.read(out=curr_seg_audio[i], fill_value=0)
+            modify_signal(curr_seg_audio, spk_id_smooth_refined,
+                          hsize, flength, seed=seg_count)
+            seg_speech[:, 1:] += (seg_count - 1) * nframe_per_seg
+            speech.append(seg_speech)
+            for i, reader in enumerate(readers):
+                writers[i].write(curr_seg_audio[i])
+            if len(writers) > len(readers):
+                writers[-1].write(curr_seg_audio.mean(axis=0))
+            seg_count = seg_count + 1
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        for file_ in readers + writers:
+            file_.close()
+    for out_file in out_files:
         LOG.debug('Written %s', out_file)
-        i += 1
-
-    # join output files
-    inputs = {k: None for k in out_files}
-    o_file = os.path.join(vad_dir, '{}.wav'.format(file_id))
-    outputs = {o_file: '-filter_complex amerge -ac 1'}
-    fnull = open(os.devnull)
-    FFmpeg(inputs=inputs, outputs=outputs).run(stdout=fnull, stderr=fnull)
-    LOG.debug('Written %s', o_file)
 
     # write segment files
-    i = 1
-    for file_ in resample_files:
+    speech = np.vstack(speech) if speech else np.empty((0, 3), dtype=np.int)
+    for i, file_ in enumerate(resample_files):
         diarize_file = os.path.join(
             diarize_dir, '{}.seg'.format(os.path.splitext(file_)[0]))
-        combine_segment(i, nsample, seg_count - 1, tolerance,
-                        discard_short_seg, nframe_per_seg * 0.01, diarize_file, temp_dir)
-        i += 1
+        combine_segment(i + 1, speech[speech[:, 0] == i + 1, 1:], nsample, tolerance,
+                        discard_short_seg, hsize, diarize_file, temp_dir, debug_samples)
+
+
+class StreamingChannel(object):
+    """Class for calculating the VAD features of one channel of a stream.
+
+    The dither and filter states, unframed samples and the VAD threshold
+    state of adapt_threshold are kept across pushes. Power sums are returned
+    as soon as their frames are complete. The pitch VAD, at the same frame
+    rate, lags behind them by the pitch frame length and the lookahead of
+    post_process_vad.
+
+    Syntax:
+        channel = StreamingChannel(sample_rate, dtype, seed)
+        power_sum, pitch_vad = channel.push(audio)
+        power_sum, pitch_vad = channel.flush()
+    """
+
+    def __init__(self, sample_rate, dtype='float64', seed=0):
+        self.sample_rate = sample_rate
+        self.dtype = np.dtype(dtype)
+        self.rng = np.random.RandomState(seed)
+        self.flength = int(sample_rate * 0.025)
+        self.hsize = int(sample_rate * 0.01)
+        self.pitch_flength = int(sample_rate * 0.1)
+        self.pitch_hsize = int(sample_rate * 0.02)
+        self.filters = [(np.array(b, dtype=self.dtype), np.array(a, dtype=self.dtype))
+                        for b, a in (DC_FILTER, PRE_EMPHASIS)]
+        self.filter_states = [np.zeros(max(len(b), len(a)) - 1, dtype=self.dtype)
+                              for b, a in self.filters]
+        self.energy_tail = np.empty(0, dtype=self.dtype)
+        self.pitch_tail = np.empty(0, dtype=self.dtype)
+        self.vad = vad_state()
+        # median filter of 3 then dilation by 20 frames, see post_process_vad
+        self.post_process = StreamFilter(
+            lambda vad: post_process_vad(vad, 20), 21, 21)
+
+    def push(self, audio):
+        """Push samples, return the new power sums and pitch VAD frames."""
+        audio = np.asarray(audio, dtype=self.dtype)
+
+        # dither, filter and frame the samples as cal_power_sum_seg
+        filtered = audio + (self.rng.randn(len(audio)) / (pow(2, 32))).astype(self.dtype)
+        for i, (b, a) in enumerate(self.filters):
+            filtered, self.filter_states[i] = scipy.signal.lfilter(
+                b, a, filtered, zi=self.filter_states[i])
+        self.energy_tail = np.concatenate([self.energy_tail, filtered])
+        power_sum = np.empty(0, dtype=self.dtype)
+        if len(self.energy_tail) >= self.flength:
+            power_sum = frame_power_sum(self.energy_tail, self.flength, self.hsize)
+            self.energy_tail = self.energy_tail[len(power_sum) * self.hsize:]
+
+        # pitch VAD of complete pitch frames as combine_vad
+        self.pitch_tail = np.concatenate([self.pitch_tail, audio])
+        nframes = (len(self.pitch_tail) - self.pitch_flength) // self.pitch_hsize + 1
+        vad_flag = np.empty(0)
+        if nframes > 0:
+            periodic_vad_val = batch_peridoc_pitch_count_fast(
+                self.pitch_tail, self.sample_rate, nframes, self.pitch_flength,
+                self.pitch_hsize, self.rng)
+            vad_flag = np.zeros(nframes)
+            for j in range(nframes):
+                self.vad = adapt_threshold(self.vad, periodic_vad_val[j])
+                vad_flag[j] = self.vad.vad_flag
+            self.pitch_tail = self.pitch_tail[nframes * self.pitch_hsize:]
+
+        # pitch frames are two energy frames apart, as interpolated in channel_vad
+        return power_sum, self.post_process.push(np.repeat(vad_flag, 2))
+
+    def flush(self):
+        """Return the remaining pitch VAD frames, with no more power sums."""
+        return np.empty(0, dtype=self.dtype), self.post_process.flush()
+
+
+class StreamingRemover(object):
+    """Class for removing crosstalk from a live multi-channel stream.
+
+    Follows crosstalk_remover, with these differences:
+        - the filter and VAD threshold states run across the whole stream,
+        instead of restarting every 20000 frames
+        - a dominant channel frame is dropped if the pitch VAD of the channel
+        is mostly off within its dominant segment, from STREAM_REFINE_BACK
+        frames before to STREAM_REFINE_AHEAD frames after the frame, instead
+        of over the whole segment
+        - the last segment of each channel is also returned
+
+    Audio is returned 41 frames (0.41 s at 100 frames/s) after the input
+    for its frame has been pushed: 10 for the pitch frame, 21 for the
+    lookahead of post_process_vad and STREAM_REFINE_AHEAD. Segments are
+    returned once they end and cannot be merged with later speech.
+
+    Syntax:
+        remover = StreamingRemover(nchans, sample_rate, dtype, tolerance, discard_short_seg)
+        audio, segments = remover.push(block)
+        audio, segments = remover.flush()
+    """
+
+    def __init__(self, nchans, sample_rate, dtype='float64', tolerance=50, discard_short_seg=50):
+        self.nchans = nchans
+        self.dtype = np.dtype(dtype)
+        self.flength = int(sample_rate * 0.025)
+        self.hsize = int(sample_rate * 0.01)
+        self.tolerance = tolerance  # frames
+        self.discard_short_seg = discard_short_seg  # frames
+        self.channels = [StreamingChannel(sample_rate, dtype, seed=i) for i in range(nchans)]
+        self.dominance = ChannelDominance(51)
+
+        # dominant channels and pitch VADs, from frame frames_base
+        self.frames_base = 0
+        self.labels = np.empty(0, dtype=np.int)
+        self.pitch = np.empty((nchans, 0))
+        self.run_label = 0
+        self.run_start = 0
+
+        # refined labels from frame refined_base, up to frame nrefined
+        self.refined_base = 0
+        self.refined = np.empty(0, dtype=np.int)
+        self.nrefined = 0
+        self.seg_label = 0
+        self.seg_start = 0
+        self.pending = [None] * nchans  # [start, stop] of segments to merge
+
+        # samples from sample audio_base, returned up to sample emitted
+        self.audio_base = 0
+        self.audio = np.empty((nchans, 0), dtype=self.dtype)
+        self.nsamples = 0
+        self.emitted = 0
+        self.nblocks = 0
+
+    def push(self, block):
+        """Push (channels, samples) audio, return the cleaned audio and segments ready."""
+        block = np.asarray(block, dtype=self.dtype)
+        self.audio = np.hstack([self.audio, block])
+        self.nsamples += block.shape[1]
+        return self.process([chan.push(block[i]) for i, chan in enumerate(self.channels)])
+
+    def flush(self):
+        """Return the remaining cleaned audio and segments."""
+        return self.process([chan.flush() for chan in self.channels], final=True)
+
+    def process(self, features, final=False):
+        """Refine and apply the VAD of all frames with enough context."""
+        labels = self.dominance.push(np.vstack([power_sum for power_sum, _ in features]))
+        if final:
+            labels = np.concatenate([labels, self.dominance.flush()])
+        self.labels = np.concatenate([self.labels, labels])
+        self.pitch = np.hstack([self.pitch, np.vstack([vad for _, vad in features])])
+
+        nlabels = self.frames_base + len(self.labels)
+        if final:
+            stop = nlabels
+        else:
+            stop = min(nlabels, self.frames_base + self.pitch.shape[1] - STREAM_REFINE_AHEAD)
+        start = self.nrefined
+        refined = self.refine(stop)
+        self.refined = np.concatenate([self.refined, refined])
+        segments = self.segments(refined, start, final)
+
+        # clean the samples with all of their frames refined
+        stop_sample = self.nsamples if final else self.nrefined * self.hsize
+        first = max(0, (self.emitted - self.flength) // self.hsize + 1)
+        audio = self.audio[:, first * self.hsize - self.audio_base:
+                           stop_sample - self.audio_base].copy()
+        modify_signal(audio, self.refined[first - self.refined_base:],
+                      self.hsize, self.flength, seed=self.nblocks)
+        audio = audio[:, self.emitted - first * self.hsize:]
+        self.emitted = max(self.emitted, stop_sample)
+        self.nblocks += 1
+
+        # drop history which is no longer needed
+        drop = max(0, self.nrefined - STREAM_REFINE_BACK) - self.frames_base
+        if drop > 0:
+            self.labels = self.labels[drop:]
+            self.pitch = self.pitch[:, drop:]
+            self.frames_base += drop
+        first = max(0, (self.emitted - self.flength) // self.hsize + 1)
+        if first > self.refined_base:
+            self.refined = self.refined[first - self.refined_base:]
+            self.refined_base = first
+        if first * self.hsize > self.audio_base:
+            self.audio = self.audio[:, first * self.hsize - self.audio_base:]
+            self.audio_base = first * self.hsize
+        return audio, segments
+
+    def refine(self, stop):
+        """Return refined labels of frames up to stop, as in gen_final_vad."""
+        refined = np.zeros(max(0, stop - self.nrefined), dtype=np.int)
+        for frame in range(self.nrefined, stop):
+            i = frame - self.frames_base
+            label = self.labels[i]
+            if label != self.run_label:
+                self.run_label = label
+                self.run_start = frame
+            ahead = self.labels[i:i + STREAM_REFINE_AHEAD + 1]
+            changes = np.flatnonzero(ahead != label)
+            end = i + (changes[0] if len(changes) else len(ahead))
+            begin = max(self.run_start, frame - STREAM_REFINE_BACK) - self.frames_base
+            curr_pitch_vad = self.pitch[label - 1, begin:end]
+            # keep the label unless the median of the pitch VAD is 0
+            if not curr_pitch_vad.shape[0] or 2 * np.sum(curr_pitch_vad) >= len(curr_pitch_vad):
+                refined[frame - self.nrefined] = label
+        self.nrefined = max(self.nrefined, stop)
+        return refined
+
+    def segments(self, refined, start, final):
+        """Return (channel, start frame, number of frames) of finished segments.
+
+        Speech segments are merged and discarded as in combine_segment.
+        """
+        segments = list()
+        for frame, label in enumerate(refined, start):
+            if label != self.seg_label:
+                if self.seg_label > 0:
+                    segments += self.merge(self.seg_label, self.seg_start, frame - 1)
+                self.seg_label = label
+                self.seg_start = frame
+        if final and self.seg_label > 0:
+            segments += self.merge(self.seg_label, self.seg_start, self.nrefined - 1)
+            self.seg_label = 0
+
+        # segments which can no longer be merged with later speech
+        for i, pending in enumerate(self.pending):
+            if pending is None:
+                continue
+            next_start = self.seg_start if self.seg_label == i + 1 else self.nrefined
+            if final or next_start - pending[1] > self.tolerance:
+                if pending[1] - pending[0] >= self.discard_short_seg:
+                    segments.append((i + 1, pending[0], pending[1] - pending[0]))
+                self.pending[i] = None
+        return sorted(segments, key=lambda seg: seg[1])
+
+    def merge(self, channel, start, stop):
+        """Merge a speech segment of a channel, return the segment it finishes."""
+        pending = self.pending[channel - 1]
+        if pending is not None and start - pending[1] <= self.tolerance:
+            pending[1] = stop
+            return []
+        self.pending[channel - 1] = [start, stop]
+        if pending is not None and pending[1] - pending[0] >= self.discard_short_seg:
+            return [(channel, pending[0], pending[1] - pending[0])]
+        return []
+
+
+def stream_crosstalk_remover(process_id, file_id, nchans, input_=None, output=None,
+                             sample_rate=16000, block_ms=40, precision='float64'):
+    """Entry point for live inputs.
+
+    Remove crosstalk from a stream of raw 16-bit little-endian PCM with
+    interleaved channels, read in blocks of block_ms from a file, a named pipe
+    or stdin. The cleaned channels are written to vad/chan*.wav, their mono
+    mix to vad/file_id.wav and optionally the channels as raw PCM to output.
+    Speech segments are appended to diarization/chan*.seg as soon as they
+    are final.
+
+    Arguments:
+        process_id: str - process id
+        file_id: str - file id
+        nchans: int - number of channels
+        input_: str - path to the input stream (default: stdin)
+        output: str - path to write the cleaned raw stream to ('-' for stdout)
+        sample_rate: int - sample rate of the input stream
+        block_ms: int - milliseconds of audio per block read
+        precision: str - floating point type of the processing, float64 or float32
+    """
+    # init paths
+    working_dir = os.path.join(DATA_DIR, process_id, file_id)
+    vad_dir = os.path.join(working_dir, 'vad/')
+    if not os.path.exists(vad_dir):
+        os.makedirs(vad_dir)
+    diarize_dir = os.path.join(working_dir, 'diarization')
+    if not os.path.exists(diarize_dir):
+        os.makedirs(diarize_dir)
+
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    in_stream = open(input_, 'rb') if input_ else stdin
+    out_stream = None
+    if output == '-':
+        out_stream = stdout
+    elif output:
+        out_stream = open(output, 'wb')
+    out_files = [os.path.join(vad_dir, 'chan{}.wav'.format(i + 1)) for i in range(nchans)]
+    out_files.append(os.path.join(vad_dir, '{}.wav'.format(file_id)))
+    writers = [sf.SoundFile(file_, 'w', sample_rate, 1) for file_ in out_files]
+    seg_files = [open(os.path.join(diarize_dir, 'chan{}.seg'.format(i + 1)), 'w')
+                 for i in range(nchans)]
+
+    remover = StreamingRemover(nchans, sample_rate, precision)
+    block_bytes = int(sample_rate * block_ms / 1000) * nchans * 2
+    max_latency = 0
+    try:
+        while True:
+            data = in_stream.read(block_bytes)
+            if data:
+                pcm = np.frombuffer(data[:len(data) // (2 * nchans) * 2 * nchans], dtype='<i2')
+                audio, segments = remover.push(pcm.reshape(-1, nchans).T / 32768.0)
+                max_latency = max(max_latency, remover.nsamples - remover.emitted)
+            else:
+                audio, segments = remover.flush()
+
+            for i in range(nchans):
+                writers[i].write(audio[i])
+            writers[-1].write(audio.mean(axis=0))
+            if out_stream is not None:
+                pcm = np.clip(np.round(audio.T * 32768.0), -32768, 32767).astype('<i2')
+                out_stream.write(pcm.tostring())
+                out_stream.flush()
+            for channel_id, start, length in segments:
+                seg_file = seg_files[channel_id - 1]
+                seg_file.write('channel{} 1 {} {} U S U S{}\n'.format(
+                    channel_id, start, length, channel_id))
+                seg_file.flush()
+            if not data:
+                break
+    finally:
+        for file_ in writers + seg_files:
+            file_.close()
+        if input_:
+            in_stream.close()
+        if output and output != '-':
+            out_stream.close()
+    LOG.debug('Processed %.1f s of audio, latency up to %d ms',
+              remover.nsamples * 1.0 / sample_rate, max_latency * 1000 // sample_rate)
 
 
 if __name__ == '__main__':
-    crosstalk_remover(sys.argv[1], sys.argv[2])
+    ARG_PARSER = argparse.ArgumentParser(
+        description='Remove crosstalk from multi-channel inputs.')
+    ARG_PARSER.add_argument('process_id', help='process id')
+    ARG_PARSER.add_argument('file_id', help='file id')
+    ARG_PARSER.add_argument('-w', '--workers', metavar='N', type=int, default=1,
+                            help='number of processes calculating channel features')
+    ARG_PARSER.add_argument('-d', '--debug', action='store_true',
+                            help='write the intermediate VADs of each segment into temp/vad')
+    ARG_PARSER.add_argument('--debug-samples', action='store_true',
+                            help='write the per-sample VAD of each channel into temp/vad')
+    ARG_PARSER.add_argument('-p', '--precision', choices=['float64', 'float32'],
+                            default='float64', help='floating point type of the processing')
+    ARG_PARSER.add_argument('-s', '--stream', metavar='channels', type=int,
+                            help='process a live stream of raw 16-bit PCM with this many '
+                            'channels')
+    ARG_PARSER.add_argument('-i', '--input', metavar='path',
+                            help='input stream or named pipe (default: stdin)')
+    ARG_PARSER.add_argument('-o', '--output', metavar='path',
+                            help='write the cleaned raw stream here (- for stdout)')
+    ARG_PARSER.add_argument('-b', '--block', metavar='ms', type=int, default=40,
+                            help='milliseconds of audio per block read from the stream')
+    ARG_PARSER.add_argument('--sample-rate', metavar='Hz', type=int, default=16000,
+                            help='sample rate of the stream')
+    ARGS = ARG_PARSER.parse_args()
+    if ARGS.stream:
+        stream_crosstalk_remover(ARGS.process_id, ARGS.file_id, ARGS.stream, input_=ARGS.input,
+                                 output=ARGS.output, sample_rate=ARGS.sample_rate,
+                                 block_ms=ARGS.block, precision=ARGS.precision)
+    else:
+        crosstalk_remover(ARGS.process_id, ARGS.file_id, workers=ARGS.workers,
+                          debug=ARGS.debug, debug_samples=ARGS.debug_samples,
+                          precision=ARGS.precision)
@@ -3,11 +3,29 @@
 from __future__ import print_function
 
 import argparse
+import ctypes
+import errno
+import hashlib
+import imp
 import json
 import logging
+import math
 import os
+import resource
 import shutil
 import subprocess
+import tempfile
+import threading
+import time
+import wave
+from functools import partial
+from multiprocessing import Pipe, Process
+from multiprocessing.pool import ThreadPool
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 try:
     from slugify import slugify
@@ -24,6 +42,10 @@ CRAWL_DIR = os.path.join(CUR_DIR, 'crawl/')
 if not os.path.exists(CRAWL_DIR):
     os.makedirs(CRAWL_DIR)
 OPERATIONS_FILE = os.path.join(CUR_DIR, 'operations.json')
+CACHE_DIR = os.path.join(DATA_DIR, '_cache/')
+CACHE_SIZE = 50 * 2**30  # default cache size limit, in bytes
+METRICS_DIR = os.path.join(DATA_DIR, '_metrics/')
+METRICS_LOCK = threading.Lock()
 
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s (%(name)s | %(levelname)s) : %(message)s')
@@ -43,6 +65,7 @@ class Manifest(object):
         with open(sys_mnft, 'r') as mnft:
             manifest = json.load(mnft)
         self.processes = manifest['processes']
+        self.options = manifest.get('options', {})
         self.def_process = manifest['default_process']
         self.procedures = manifest['procedures']
         self.def_procedures = manifest['default_procedures']
@@ -107,6 +130,9 @@ class Manifest(object):
                 for mod_name, mod_ver in self.processes[self.def_process].items():
                     if mod_name not in proc_:
                         proc_[mod_name] = mod_ver
+                # fill default module options
+                for mod_name, mod_opts in self.options.get(self.def_process, {}).items():
+                    self.options.setdefault(process_id, {}).setdefault(mod_name, mod_opts)
                 process_mods = sorted(['{}-{}'.format(x, self.processes[process_id][x])
                                        for x in self.processes[process_id]])
                 LOG.info('Process %s: %s', process_id, ', '.join(process_mods))
@@ -115,6 +141,7 @@ class Manifest(object):
         """Cache the manifest."""
         manifest = {}
         manifest['processes'] = self.processes
+        manifest['options'] = self.options
         manifest['default_process'] = self.def_process
         manifest['procedures'] = self.procedures
         manifest['default_procedures'] = self.def_procedures
@@ -132,6 +159,96 @@ class Manifest(object):
         self.to_json()
 
 
+def usage_dict(rusage, io=None):
+    """Convert a resource usage structure and I/O counters into a dict.
+
+    cpu times are in seconds, max_rss in kilobytes, read/ write bytes are the
+    bytes read/ written through system calls, including page cache hits (rchar/
+    wchar of proc_io()), or None if not available.
+    """
+    return {
+        'user_time': rusage.ru_utime,
+        'sys_time': rusage.ru_stime,
+        'cpu_time': rusage.ru_utime + rusage.ru_stime,
+        'max_rss': rusage.ru_maxrss,
+        'read_bytes': io['rchar'] if io else None,
+        'write_bytes': io['wchar'] if io else None,
+    }
+
+
+def proc_io(pid='self'):
+    """Return the I/O counters of a process from /proc/<pid>/io as a dict, or None.
+
+    The counters of a process include those of its reaped children.
+    """
+    try:
+        with open('/proc/{}/io'.format(pid), 'r') as file_:
+            return dict((key, int(value)) for key, value in
+                        (line.split(':') for line in file_ if line.strip()))
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def wait_exit(pid):
+    """Wait for a child process to exit, without reaping it."""
+    if hasattr(os, 'waitid'):
+        os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+        return
+    # no os.waitid in python 2, call it from libc (linux values of the flags)
+    libc = ctypes.CDLL(None, use_errno=True)
+    siginfo = ctypes.create_string_buffer(128)
+    while libc.waitid(1, pid, siginfo, 0x04 | 0x01000000):  # P_PID, WEXITED | WNOWAIT
+        if ctypes.get_errno() != errno.EINTR:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+
+def module_args(options):
+    """Return the command line arguments of module options, e.g. --max-size 5 for max_size: 5.
+
+    Boolean options are passed as --name if true, and as --no-name if false.
+    """
+    args = []
+    for name, value in sorted(options.items()):
+        flag = '--{}'.format(name.replace('_', '-'))
+        if isinstance(value, bool):
+            args.append(flag if value else '--no-' + flag[2:])
+        else:
+            args += [flag, str(value)]
+    return args
+
+
+def media_duration(working_dir):
+    """Return the duration (in seconds) of the resampled audio of a working_dir, or None."""
+    durations = []
+    resample_dir = os.path.join(working_dir, 'resample/')
+    if not os.path.exists(resample_dir):
+        return None
+    for file_ in os.listdir(resample_dir):
+        try:
+            wav = wave.open(os.path.join(resample_dir, file_), 'r')
+            try:
+                durations.append(wav.getnframes() * 1.0 / wav.getframerate())
+            finally:
+                wav.close()
+        except (wave.Error, EOFError, IOError):
+            continue
+    return max(durations) if durations else None
+
+
+def write_metrics(record):
+    """Append a metrics record to the metrics log of the day."""
+    if not os.path.exists(METRICS_DIR):
+        try:
+            os.makedirs(METRICS_DIR)
+        except OSError:  # created concurrently
+            pass
+    metrics_file = os.path.join(METRICS_DIR, '{}.jsonl'.format(
+        time.strftime('%Y-%m-%d', time.localtime(record['time']))))
+    with METRICS_LOCK:
+        with open(metrics_file, 'a') as file_:
+            file_.write(json.dumps(record, sort_keys=True) + '\n')
+
+
 class Operation(object):
     """Class holding a processing task, on a single file_id.
 
@@ -241,41 +358,658 @@ class Operation(object):
             if os.path.exists(raw_dir) and os.listdir(raw_dir):
                 LOG.info('Previously imported to %s', raw_dir)
 
-    def call(self, module_id):
-        """Atom instruction to call a module."""
+    def options(self, module_id):
+        """Return the options of a module in the process, as keyword arguments."""
+        mod_name = self.manifest.modules[module_id]['name']
+        return self.manifest.options.get(self.process_id, {}).get(mod_name, {})
+
+    def spawn(self, module_id):
+        """Run a module in a new process. Return (exit_code, resource usage)."""
         try:
             exec_ = os.path.join(MODULES_DIR, module_id, 'module.py')
-            args = ['python', exec_, self.process_id, self.file_id]
-            subprocess.call(args)
-            return True
+            args = ['python', exec_, self.process_id, self.file_id] + \
+                module_args(self.options(module_id))
+            proc = subprocess.Popen(args)
+            # the I/O counters of the child are gone once it is reaped
+            try:
+                wait_exit(proc.pid)
+                io = proc_io(proc.pid)
+            except OSError:
+                io = None
+            _, status, rusage = os.wait4(proc.pid, 0)
+            if os.WIFSIGNALED(status):
+                proc.returncode = -os.WTERMSIG(status)
+            else:
+                proc.returncode = os.WEXITSTATUS(status)
+            return proc.returncode, usage_dict(rusage, io)
         except BaseException:
             LOG.info('Error occured.', exc_info=True)
-            return False
+            return None, None
+
+    def call(self, module_id, runner=None):
+        """Atom instruction to call a module, optionally using a Runner.
+
+        The resource usage of the call is written to the metrics log.
+        """
+        start = time.time()
+        result = None
+        if runner:
+            result = runner.call(module_id, self.process_id, self.file_id,
+                                 self.options(module_id))
+        exit_code, usage = result or self.spawn(module_id)
+        record = {
+            'time': start,
+            'process_id': self.process_id,
+            'procedure_id': self.procedure_id,
+            'file_id': self.file_id,
+            'module_id': module_id,
+            'in_process': result is not None,
+            'exit_code': exit_code,
+            'wall_time': time.time() - start,
+            'duration': media_duration(self.working_dir),
+        }
+        record.update(usage or {})
+        write_metrics(record)
+        return exit_code == 0
 
     def pipeline(self):
-        """Pipeline for processing."""
-        if self.simulate:  # just print and return
-            LOG.info('%s', self.__repr__())
-            return
+        """Pipeline for processing. Return True if the pipeline completed."""
+        return Schedule([self]).run()[0][1]
+
+
+def list_files(working_dir, dirs):
+    """Return a sorted list of file paths under dirs, relative to working_dir."""
+    files = []
+    for dir_ in dirs:
+        for root, _, names in os.walk(os.path.join(working_dir, dir_)):
+            files += [os.path.relpath(os.path.join(root, x), working_dir) for x in names]
+    return sorted(files)
+
+
+def overlap(dirs_a, dirs_b):
+    """Return True if any folder of dirs_a is, contains or is contained in any of dirs_b."""
+    for dir_a in dirs_a:
+        for dir_b in dirs_b:
+            dir_a, dir_b = os.path.normpath(dir_a), os.path.normpath(dir_b)
+            if dir_a == dir_b or dir_a.startswith(dir_b + os.sep) or \
+                    dir_b.startswith(dir_a + os.sep):
+                return True
+    return False
+
+
+def snapshot(working_dir, dirs):
+    """Return a dict of relative file paths to stats under dirs."""
+    stats = {}
+    for rel_path in list_files(working_dir, dirs):
+        stat = os.stat(os.path.join(working_dir, rel_path))
+        stats[rel_path] = (stat.st_ino, stat.st_size, stat.st_mtime)
+    return stats
+
+
+class Ledger(object):
+    """Class holding the record of completed modules on a working_dir.
+
+    A module is recorded with the fingerprints (size, mtime) of its input files
+    and the list of its output files: those it created or changed, and those
+    already in its output folders which no other module is recorded with (e.g.
+    outputs of a module skipping previous work). It is considered done while
+    its inputs are unchanged and its outputs still exist.
+
+    Syntax: Ledger(working_dir)
+    """
+
+    def __init__(self, working_dir):
+        self.working_dir = working_dir
+        self.ledger_file = os.path.join(working_dir, 'ledger.json')
+        self.lock = threading.Lock()
+        try:
+            with open(self.ledger_file, 'r') as json_:
+                self.stages = json.load(json_)
+        except (IOError, OSError, ValueError):
+            self.stages = {}
+
+    def fingerprint(self, dirs):
+        """Return a dict of relative file paths to [size, mtime] under dirs."""
+        fingerprint = {}
+        for rel_path in list_files(self.working_dir, dirs):
+            stat = os.stat(os.path.join(self.working_dir, rel_path))
+            fingerprint[rel_path] = [stat.st_size, stat.st_mtime]
+        return fingerprint
+
+    def done(self, module_id, module):
+        """Return True if a module (manifest) is recorded as done, with the same inputs."""
+        with self.lock:
+            stage = self.stages.get(module_id)
+        if not stage or stage['inputs'] != self.fingerprint(module['inputs']):
+            return False
+        return all(os.path.exists(os.path.join(self.working_dir, x)) for x in stage['outputs'])
+
+    def record(self, module_id, module, before):
+        """Record a module (manifest) as done, if it has any output files.
+
+        Return the list of recorded output files.
+        """
+        after = snapshot(self.working_dir, module['outputs'])
+        with self.lock:
+            owned = set(x for stage_id, stage in self.stages.items() if stage_id != module_id
+                        for x in stage['outputs'])
+            outputs = sorted(x for x in after if before.get(x) != after[x] or x not in owned)
+            if not outputs:
+                return outputs
+            self.stages[module_id] = {'inputs': self.fingerprint(module['inputs']),
+                                      'outputs': outputs}
+            tmp_fd, tmp = tempfile.mkstemp(dir=self.working_dir)
+            with os.fdopen(tmp_fd, 'w') as json_:
+                json.dump(self.stages, json_, sort_keys=True, indent=4)
+            os.rename(tmp, self.ledger_file)
+        return outputs
+
+
+class Schedule(object):
+    """Class holding the module dependency graph for operations on a single working_dir.
+
+    Operations are run in stages of consecutive operations, in which every
+    module reads its inputs from the same modules as in its own procedure.
+    Within a stage, modules shared between procedures are run once, and
+    modules which neither depend on each other's outputs nor write to the same
+    folders are run in parallel.
+
+    Modules recorded as done in the working_dir Ledger are skipped, unless forced.
+
+    Syntax: Schedule(operations, runner=None, cache=None, force=False)
+    """
+
+    def __init__(self, operations, runner=None, cache=None, force=False):
+        self.operations = operations
+        self.runner = runner
+        self.cache = cache
+        self.force = force
+
+        # set later during build()
+        self.module_ids = None
+        self.deps = None
+        self.required = None
+
+    @staticmethod
+    def producers(operation, idx):
+        """Return the producers of the inputs of the idx-th module of an operation."""
+        modules = operation.manifest.modules
+        mod_id = operation.module_list[idx]
+        return set(x for x in operation.module_list[:idx]
+                   if x != mod_id and overlap(modules[mod_id]['inputs'], modules[x]['outputs']))
+
+    @staticmethod
+    def consistent(operations):
+        """Return True if operations could be run as a single stage.
+
+        That is, if every module would read its inputs from the same modules as
+        in its own procedure, and from no other module of the stage.
+        """
+        modules = operations[0].manifest.modules
+        mod_ids = set(x for operation in operations for x in operation.module_list)
+        for operation in operations:
+            for idx, mod_id in enumerate(operation.module_list):
+                writers = set(x for x in mod_ids if x != mod_id and overlap(
+                    modules[mod_id]['inputs'], modules[x]['outputs']))
+                if writers != Schedule.producers(operation, idx):
+                    return False
+        return True
+
+    def stages(self, operations):
+        """Split verified operations into stages of consecutive operations."""
+        stages = []
+        for operation in operations:
+            if stages and self.consistent(stages[-1] + [operation]):
+                stages[-1].append(operation)
+            else:
+                stages.append([operation])
+        return stages
+
+    def build(self, operations):
+        """Build the module dependency graph of the verified operations of a stage.
+
+        A module waits for the modules listed before it which produce any of
+        its inputs, and is skipped if any of those fails. Modules writing to
+        the same folders, or to the inputs of another, are never run together.
+        """
+        modules = operations[0].manifest.modules
+        first_seen = []
+        producers = {}
+        for operation in operations:
+            for idx, mod_id in enumerate(operation.module_list):
+                if mod_id not in first_seen:
+                    first_seen.append(mod_id)
+                producers.setdefault(mod_id, set()).update(self.producers(operation, idx))
+
+        # topological order of the producers, ties in order of appearance
+        self.module_ids = []
+        while len(self.module_ids) < len(first_seen):
+            ready = [x for x in first_seen if x not in self.module_ids and
+                     producers[x] <= set(self.module_ids)]
+            if not ready:
+                raise ValueError('Procedures order modules in a cycle: {}'.format(
+                    [x for x in first_seen if x not in self.module_ids]))
+            self.module_ids.append(ready[0])
+
+        self.deps = {}
+        self.required = {}
+        for idx, mod_id in enumerate(self.module_ids):
+            module = modules[mod_id]
+            self.required[mod_id] = producers[mod_id]
+            self.deps[mod_id] = producers[mod_id] | set(
+                x for x in self.module_ids[:idx]
+                if overlap(module['outputs'], modules[x]['outputs']) or
+                overlap(module['outputs'], modules[x]['inputs']))
+
+    def execute(self, operations):
+        """Run the module dependency graph. Return a dict of module results."""
+        callers = {}
+        for operation in operations:
+            for mod_id in operation.module_list:
+                callers.setdefault(mod_id, operation)
+
+        modules = operations[0].manifest.modules
+        ledger = Ledger(operations[0].working_dir)
+
+        def call(mod_id):
+            """Call a module using one of the operations requiring it.
+
+            Errors fail the module, so that its result always reaches the scheduler.
+            """
+            try:
+                if not self.force and ledger.done(mod_id, modules[mod_id]):
+                    LOG.info('Module %s previously completed, inputs unchanged', mod_id)
+                    return mod_id, True
+                operation = callers[mod_id]
+                before = snapshot(operation.working_dir, modules[mod_id]['outputs'])
+                key = None
+                if self.cache:
+                    key = self.cache.key(operation.working_dir, operation.file_id,
+                                         modules[mod_id], operation.options(mod_id))
+                if key and self.cache.fetch(key, operation.working_dir):
+                    LOG.info('Cache hit for module %s on %s', mod_id, operation.file_id)
+                    ledger.record(mod_id, modules[mod_id], before)
+                    return mod_id, True
+                result = operation.call(mod_id, self.runner)
+                if result:
+                    outputs = ledger.record(mod_id, modules[mod_id], before)
+                    if key:
+                        self.cache.store(key, operation.working_dir, mod_id, outputs)
+                return mod_id, result
+            except Exception:
+                LOG.info('Error occured in module %s.', mod_id, exc_info=True)
+                return mod_id, False
+
+        status = {}
+        started = set()
+        done = queue.Queue()
+        pool = ThreadPool(len(self.module_ids))
+        try:
+            while True:
+                # module_ids is in topological order, so failures cascade in a single pass
+                for mod_id in self.module_ids:
+                    if mod_id in started or mod_id in status:
+                        continue
+                    if any(status.get(x) is False for x in self.required[mod_id]):
+                        LOG.info('Skipping module %s, dependencies failed', mod_id)
+                        status[mod_id] = False
+                    elif all(x in status for x in self.deps[mod_id]):
+                        started.add(mod_id)
+                        pool.apply_async(call, (mod_id,), callback=done.put)
+                if len(status) == len(self.module_ids):
+                    break
+                mod_id, result = done.get()
+                status[mod_id] = result
+        finally:
+            pool.close()
+            pool.join()
+        return status
+
+    def run(self):
+        """Run the operations. Return a list of (operation, result) tuples."""
+        results = [None] * len(self.operations)
+        valid = []
+        for idx, operation in enumerate(self.operations):
+            if operation.simulate:  # just print
+                LOG.info('%s', operation)
+                results[idx] = True
+            elif operation.verify():
+                valid.append(idx)
+            else:
+                LOG.info('Verification failed for %s', operation)
+                results[idx] = False
+        if not valid:
+            return list(zip(self.operations, results))
         print('\n')
 
-        if self.verify():
-            LOG.info('Process: %s', self.process_id)
-            LOG.info('Procedure: %s', self.procedure_id)
-            if self.file_names:
-                LOG.info('Files: %s', self.file_names)
-            LOG.info('File ID: %s', self.file_id)
-            self.import_files()
-            for mod_id in self.module_list:
-                if not self.call(mod_id):
-                    # module failure, terminate operation
-                    LOG.info('Pipeline failed for %s at process %s, procedure %s, module %s',
-                             self.file_id, self.process_id, self.procedure_id, mod_id)
-                    return
-            LOG.info('Pipeline completed for %s using process %s, procedure %s',
-                     self.file_id, self.process_id, self.procedure_id)
-        else:
-            LOG.info('Verification failed for %s', self._str)
+        operations = [self.operations[idx] for idx in valid]
+        for operation in operations:
+            LOG.info('Process: %s', operation.process_id)
+            LOG.info('Procedure: %s', operation.procedure_id)
+            if operation.file_names:
+                LOG.info('Files: %s', operation.file_names)
+            LOG.info('File ID: %s', operation.file_id)
+            operation.import_files()
+        status = {}
+        for stage in self.stages(operations):
+            self.build(stage)
+            stage_status = self.execute(stage)
+            for operation in stage:
+                status[operation] = [x for x in operation.module_list if not stage_status[x]]
+        for idx, operation in zip(valid, operations):
+            failed = status[operation]
+            if failed:
+                LOG.info('Pipeline failed for %s at process %s, procedure %s, module %s',
+                         operation.file_id, operation.process_id, operation.procedure_id,
+                         failed[0])
+            else:
+                LOG.info('Pipeline completed for %s using process %s, procedure %s',
+                         operation.file_id, operation.process_id, operation.procedure_id)
+            results[idx] = not failed
+        return list(zip(self.operations, results))
+
+
+class Cache(object):
+    """Class holding a content-addressed cache of module outputs, shared across processes.
+
+    Entries are keyed by the module name/ version and options, the file_id,
+    which modules name their outputs after, and the contents of its input
+    folders. Output files are stored once per content hash, and are
+    materialized into working_dirs as copies, so that modules writing to them
+    in place cannot change the cache.
+
+    Syntax: Cache(cache_dir=CACHE_DIR)
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        self.entries_dir = os.path.join(cache_dir, 'entries')
+        for dir_ in [self.objects_dir, self.entries_dir]:
+            if not os.path.exists(dir_):
+                os.makedirs(dir_)
+        self.hashes = {}  # (path, inode, size, mtime) -> content hash
+        self.lock = threading.Lock()
+
+    def file_hash(self, path):
+        """Return the content hash of a file, memoized on its stat."""
+        stat = os.stat(path)
+        memo_key = (path, stat.st_ino, stat.st_size, stat.st_mtime)
+        with self.lock:
+            if memo_key in self.hashes:
+                return self.hashes[memo_key]
+        sha = hashlib.sha1()
+        with open(path, 'rb') as file_:
+            for chunk in iter(lambda: file_.read(2**20), b''):
+                sha.update(chunk)
+        with self.lock:
+            self.hashes[memo_key] = sha.hexdigest()
+        return self.hashes[memo_key]
+
+    def key(self, working_dir, file_id, module, options=None):
+        """Return the cache key of a module (manifest) and its options on a file_id."""
+        sha = hashlib.sha1()
+        sha.update('{}-{}\n'.format(module['name'], module['version']).encode('utf-8'))
+        sha.update('{}\n'.format(file_id).encode('utf-8'))
+        sha.update('{}\n'.format(json.dumps(options or {}, sort_keys=True)).encode('utf-8'))
+        for rel_path in list_files(working_dir, sorted(module['inputs'])):
+            file_hash = self.file_hash(os.path.join(working_dir, rel_path))
+            sha.update('{} {}\n'.format(rel_path, file_hash).encode('utf-8'))
+        return sha.hexdigest()
+
+    def object_path(self, file_hash):
+        """Return the path of a stored object."""
+        return os.path.join(self.objects_dir, file_hash[:2], file_hash)
+
+    def fetch(self, key, working_dir):
+        """Materialize a cache entry into working_dir. Return True on a hit."""
+        entry_path = os.path.join(self.entries_dir, '{}.json'.format(key))
+        try:
+            with open(entry_path, 'r') as json_:
+                entry = json.load(json_)
+        except (IOError, OSError, ValueError):
+            return False
+        files = entry['files']
+        if not all(os.path.exists(self.object_path(x)) for x in files.values()):
+            return False  # partially pruned
+        for rel_path, file_hash in sorted(files.items()):
+            dest = os.path.join(working_dir, rel_path)
+            if os.path.exists(dest):
+                if self.file_hash(dest) == file_hash:
+                    continue
+            elif not os.path.exists(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            tmp_fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dest))
+            os.close(tmp_fd)
+            shutil.copy2(self.object_path(file_hash), tmp)
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, dest)
+        os.utime(entry_path, None)  # mark as recently used
+        return True
+
+    def store(self, key, working_dir, module_id, outputs):
+        """Store the output files of a module, relative to working_dir."""
+        files = {}
+        for rel_path in sorted(outputs):
+            src = os.path.join(working_dir, rel_path)
+            file_hash = self.file_hash(src)
+            obj = self.object_path(file_hash)
+            if not os.path.exists(obj):
+                if not os.path.exists(os.path.dirname(obj)):
+                    try:
+                        os.makedirs(os.path.dirname(obj))
+                    except OSError:  # created concurrently
+                        pass
+                tmp_fd, tmp = tempfile.mkstemp(dir=self.objects_dir)
+                os.close(tmp_fd)
+                shutil.copy2(src, tmp)
+                os.chmod(tmp, 0o444)
+                os.rename(tmp, obj)
+            files[rel_path] = file_hash
+        if not files:
+            return
+        tmp_fd, tmp = tempfile.mkstemp(dir=self.entries_dir)
+        with os.fdopen(tmp_fd, 'w') as json_:
+            json.dump({'module_id': module_id, 'files': files}, json_, sort_keys=True, indent=4)
+        os.rename(tmp, os.path.join(self.entries_dir, '{}.json'.format(key)))
+        LOG.info('Cached %s output files of module %s', len(files), module_id)
+
+    def entries(self):
+        """Return a list of (mtime, key, entry), least recently used first."""
+        entries = []
+        for name in os.listdir(self.entries_dir):
+            if not name.endswith('.json'):
+                continue
+            entry_path = os.path.join(self.entries_dir, name)
+            try:
+                with open(entry_path, 'r') as json_:
+                    entry = json.load(json_)
+                entries.append((os.path.getmtime(entry_path), name[:-5], entry))
+            except (IOError, OSError, ValueError):
+                continue
+        return sorted(entries)
+
+    def objects(self):
+        """Return a dict of stored object hashes to sizes."""
+        objects = {}
+        for root, _, names in os.walk(self.objects_dir):
+            if root == self.objects_dir:  # skip temp files
+                continue
+            for name in names:
+                objects[name] = os.path.getsize(os.path.join(root, name))
+        return objects
+
+    def stats(self):
+        """Return a dict of cache statistics."""
+        objects = self.objects()
+        return {'entries': len(self.entries()),
+                'objects': len(objects),
+                'size': sum(objects.values())}
+
+    def prune(self, max_size=CACHE_SIZE):
+        """Evict least recently used entries until the cache fits in max_size bytes.
+
+        Return (number of evicted entries, number of freed bytes).
+        """
+        entries = self.entries()
+        objects = self.objects()
+        refs = {}
+        for _, _, entry in entries:
+            for file_hash in entry['files'].values():
+                refs[file_hash] = refs.get(file_hash, 0) + 1
+        size = sum(objects.get(x, 0) for x in refs)
+        evicted = 0
+        for _, key, entry in entries:
+            if size <= max_size:
+                break
+            os.remove(os.path.join(self.entries_dir, '{}.json'.format(key)))
+            evicted += 1
+            for file_hash in entry['files'].values():
+                refs[file_hash] -= 1
+                if not refs[file_hash]:
+                    size -= objects.get(file_hash, 0)
+                    del refs[file_hash]
+        # remove unreferenced objects
+        freed = 0
+        for file_hash, obj_size in objects.items():
+            if file_hash not in refs:
+                os.remove(self.object_path(file_hash))
+                freed += obj_size
+        return evicted, freed
+
+
+def run_worker(conn, module_id, entry):
+    """Worker loop for Runner.
+
+    Load the entry point of a module once, then call it for every job
+    received on conn until None is received.
+    """
+    # replacement workers are forked while other threads may hold logging locks
+    logging._lock = threading.RLock()  # pylint: disable=protected-access
+    for handler in logging.getLogger().handlers:
+        handler.createLock()
+    func = None
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        process_id, file_id, options = job
+        cur_dir = os.getcwd()
+        before = [resource.getrusage(x)
+                  for x in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]]
+        io_before = proc_io()
+        try:
+            if func is None:
+                exec_ = os.path.join(MODULES_DIR, module_id, 'module.py')
+                module = imp.load_source(
+                    'module_{}'.format(slugify(module_id, separator='_')), exec_)
+                func = getattr(module, entry)
+            func(process_id, file_id, **options)
+            exit_code = 0
+        except SystemExit as exit_:
+            # as for a module run as a script, sys.exit() or sys.exit(0) is a success
+            if exit_.code is None or isinstance(exit_.code, int):
+                exit_code = exit_.code or 0
+            else:
+                exit_code = 1
+            if exit_code:
+                LOG.info('Module %s exited with code %s.', module_id, exit_code)
+        except BaseException:
+            LOG.info('Error occured in module %s.', module_id, exc_info=True)
+            exit_code = 1
+        finally:
+            os.chdir(cur_dir)  # some modules change the working directory
+        after = [resource.getrusage(x)
+                 for x in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]]
+        io_after = proc_io()
+        # usage of this call (self and children), max_rss is the peak of the worker
+        usage = usage_dict(after[0])
+        for key in ['user_time', 'sys_time', 'cpu_time']:
+            usage[key] += usage_dict(after[1])[key] - \
+                usage_dict(before[0])[key] - usage_dict(before[1])[key]
+        usage['max_rss'] = max(after[0].ru_maxrss, after[1].ru_maxrss)
+        if io_before and io_after:  # counters of self include the reaped children
+            usage['read_bytes'] = io_after['rchar'] - io_before['rchar']
+            usage['write_bytes'] = io_after['wchar'] - io_before['wchar']
+        conn.send((exit_code, usage))
+
+
+class Runner(object):
+    """Class holding pools of long-lived worker processes, which run modules in-process.
+
+    Each module has its own pool, of as many workers as calls of the module
+    could run at once, so that a worker imports only its module, and only
+    once. The pools are filled before any scheduler threads are started. A
+    worker which dies only fails the module call it was running, and is
+    replaced by a new one.
+
+    Syntax: Runner(manifest, sizes)
+    """
+
+    def __init__(self, manifest, sizes):
+        self.manifest = manifest
+        self.pools = {}  # module_id -> queue of idle (process, connection)
+        self.workers = []
+        self.lock = threading.Lock()
+        for module_id, size in sorted(sizes.items()):
+            self.pools[module_id] = queue.Queue()
+            for _ in range(size):
+                self.pools[module_id].put(self.spawn(module_id))
+
+    def spawn(self, module_id):
+        """Start a new worker for a module. Return (process, connection)."""
+        module = self.manifest.modules[module_id]
+        # one at a time, so that no worker inherits the child end of another's pipe
+        with self.lock:
+            conn, child_conn = Pipe()
+            worker = Process(target=run_worker,
+                             args=(child_conn, module_id, module.get('entry', module['name'])))
+            worker.start()
+            child_conn.close()  # so that recv() fails if the worker dies
+            self.workers.append(worker)
+        return worker, conn
+
+    def call(self, module_id, process_id, file_id, options=None):
+        """Call a module in an idle worker of its pool. Return (exit_code, resource usage).
+
+        options are passed to the entry point as keyword arguments. Return None
+        if the module has no pool.
+        """
+        if module_id not in self.pools:
+            return None
+        worker, conn = self.pools[module_id].get()
+        try:
+            conn.send((process_id, file_id, options or {}))
+            result = conn.recv()
+        except (EOFError, IOError, OSError):
+            worker.join()
+            LOG.info('Worker for module %s exited with code %s',
+                     module_id, worker.exitcode)
+            self.pools[module_id].put(self.spawn(module_id))
+            return worker.exitcode, None
+        self.pools[module_id].put((worker, conn))
+        return result
+
+    def close(self):
+        """Stop all workers."""
+        for pool in self.pools.values():
+            while True:
+                try:
+                    _, conn = pool.get_nowait()
+                except queue.Empty:
+                    break
+                conn.send(None)
+        for worker in self.workers:
+            worker.join()
+
+
+def procedure_modules(manifest, process_id, procedure_id):
+    """Return the module_ids of a procedure in a process, skipping unknown modules."""
+    process = manifest.processes.get(process_id, {})
+    return ['{}-{}'.format(x, process[x])
+            for x in manifest.procedures.get(procedure_id, []) if x in process]
 
 
 def setup(args):
@@ -299,19 +1033,54 @@ def setup(args):
                 LOG.info('Setup failed for module %s', mod_id)
 
 
-def workflow_single(manifest, process_id, procedures, file_names,
-                    file_id, test=False, simulate=False):
+def workflow_single(manifest, process_id, procedures, file_names, file_id,
+                    test=False, simulate=False, in_process=False, cache=None, force=False):
     """Processing workflow for a single file_id."""
     if test:  # manifest check only, no processing
         return
 
-    for procedure_id in procedures:
-        Operation(manifest, process_id, procedure_id,
-                  file_names, file_id, simulate).pipeline()
+    operations = [Operation(manifest, process_id, procedure_id, file_names, file_id, simulate)
+                  for procedure_id in procedures]
+    runner = None
+    if in_process and not simulate:
+        runner = Runner(manifest, dict(
+            (x, 1) for procedure_id in procedures
+            for x in procedure_modules(manifest, process_id, procedure_id)))
+    try:
+        summarize(Schedule(operations, runner, cache, force).run())
+    finally:
+        if runner:
+            runner.close()
+
+
+def run_group(operations, runner=None, cache=None, force=False):
+    """Run operations on the same working_dir as a single schedule.
+
+    Return a list of (operation, result) tuples. An error fails all operations
+    of the group, but not the other groups of a batch.
+    """
+    try:
+        return Schedule(operations, runner, cache, force).run()
+    except Exception:
+        LOG.info('Error occured in %s.', operations[0], exc_info=True)
+        return [(operation, False) for operation in operations]
+
+
+def summarize(results):
+    """Log an aggregate summary of (operation, result) tuples."""
+    failed = [operation for operation, result in results if not result]
+    LOG.info('Summary: %s operations, %s succeeded, %s failed',
+             len(results), len(results) - len(failed), len(failed))
+    for operation in failed:
+        LOG.info('Failed: %s', operation)
 
 
-def workflow_batch(manifest):
-    """Batch processing workflow using operations.json."""
+def workflow_batch(manifest, jobs=1, in_process=False, cache=None, force=False):
+    """Batch processing workflow using operations.json.
+
+    Operations on different working_dirs are run in a pool of jobs workers,
+    operations on the same working_dir are run as a single schedule.
+    """
     # read OPERATIONS_FILE
     try:
         with open(OPERATIONS_FILE, 'r') as json_:
@@ -336,20 +1105,127 @@ def workflow_batch(manifest):
             parsed_op['procedure_id'] = procedure_id
             parsed_ops.append(parsed_op)
 
-    # do operations
+    # group operations by working_dir, keeping the order within each group
+    groups = []
+    group_idx = {}
     for operation in parsed_ops:
-        Operation(manifest, **operation).pipeline()
+        operation = Operation(manifest, **operation)
+        key = getattr(operation, 'working_dir', repr(operation))
+        if key not in group_idx:
+            group_idx[key] = len(groups)
+            groups.append([])
+        groups[group_idx[key]].append(operation)
+
+    # one worker per module for each group which could run it at once,
+    # started before any threads
+    runner = None
+    if in_process:
+        sizes = {}
+        for group in groups:
+            for mod_id in set(x for operation in group if not operation.simulate
+                              for x in procedure_modules(manifest, operation.process_id,
+                                                         operation.procedure_id)):
+                sizes[mod_id] = min(sizes.get(mod_id, 0) + 1, jobs)
+        runner = Runner(manifest, sizes)
+
+    # do operations
+    try:
+        if jobs > 1:
+            pool = ThreadPool(jobs)
+            try:
+                group_results = pool.map(
+                    partial(run_group, runner=runner, cache=cache, force=force), groups)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            group_results = [run_group(group, runner, cache, force) for group in groups]
+    finally:
+        if runner:
+            runner.close()
+    summarize([x for results in group_results for x in results])
 
 
 def process(args):
     """Wrapper for processing workflows."""
     manifest = Manifest()
     manifest.check_all()
-    if args.batch:
-        workflow_batch(manifest)
-    else:
-        workflow_single(manifest, args.process_id, args.procedures,
-                        args.files, args.id, args.test, args.simulate)
+    cache = Cache() if args.cache else None
+    try:
+        if args.batch:
+            workflow_batch(manifest, args.jobs, args.in_process, cache, args.force)
+        else:
+            workflow_single(manifest, args.process_id, args.procedures, args.files, args.id,
+                            args.test, args.simulate, args.in_process, cache, args.force)
+    finally:
+        if cache:
+            cache.prune()
+
+
+def percentile(values, pct):
+    """Return the pct-th percentile (nearest rank) of a sorted list of values."""
+    return values[max(0, int(math.ceil(pct / 100.0 * len(values))) - 1)]
+
+
+def stats(args):
+    """Print per-module statistics from the metrics logs."""
+    records = {}
+    if os.path.exists(METRICS_DIR):
+        for file_ in sorted(os.listdir(METRICS_DIR)):
+            with open(os.path.join(METRICS_DIR, file_), 'r') as jsonl:
+                for line in jsonl:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:  # partially written line
+                        continue
+                    if args.process_id and record['process_id'] != args.process_id:
+                        continue
+                    records.setdefault(record['module_id'], []).append(record)
+    if not records:
+        LOG.info('No metrics found in %s', METRICS_DIR)
+        return
+
+    row = '{:<16} {:>6} {:>6} {:>12} {:>10} {:>10} {:>12}'
+    print(row.format('module_id', 'calls', 'failed', 'audio s/s', 'p50 (s)', 'p95 (s)',
+                     'max rss (MB)'))
+    for module_id, mod_records in sorted(records.items()):
+        ok_records = [x for x in mod_records if x['exit_code'] == 0]
+        failed = len(mod_records) - len(ok_records)
+        if not ok_records:
+            print(row.format(module_id, len(mod_records), failed, '-', '-', '-', '-'))
+            continue
+        walls = sorted(x['wall_time'] for x in ok_records)
+        timed = [x for x in ok_records if x.get('duration')]
+        if timed:
+            throughput = '{:.2f}'.format(sum(x['duration'] for x in timed) /
+                                         max(sum(x['wall_time'] for x in timed), 1e-9))
+        else:
+            throughput = '-'
+        max_rss = max(x.get('max_rss') or 0 for x in ok_records) / 1024.0
+        print(row.format(module_id, len(mod_records), failed, throughput,
+                         '{:.2f}'.format(percentile(walls, 50)),
+                         '{:.2f}'.format(percentile(walls, 95)),
+                         '{:.1f}'.format(max_rss)))
+
+
+def parse_size(size):
+    """Parse a size string (e.g. 500M, 20G) into bytes."""
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+    size = size.strip().upper()
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def cache_(args):
+    """Show statistics of, or prune the stage cache."""
+    cache = Cache()
+    if args.action == 'prune':
+        evicted, freed = cache.prune(args.max_size)
+        LOG.info('Evicted %s entries, freed %s bytes', evicted, freed)
+    stats = cache.stats()
+    LOG.info('Cache at %s: %s entries, %s objects, %s bytes',
+             CACHE_DIR, stats['entries'], stats['objects'], stats['size'])
 
 
 def main():
@@ -370,6 +1246,8 @@ def main():
     process_parser = sub_parsers.add_parser('process', help='process files')
     process_parser.add_argument(
         '-b', '--batch', action='store_true', help='batch mode')
+    process_parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                                help='number of file_ids to process in parallel (batch mode)')
 
     process_parser.add_argument(
         'process_id', help='process_id for this run', nargs='?')
@@ -384,8 +1262,29 @@ def main():
         '-t', '--test', action='store_true', help='just do system checks and exit')
     process_parser.add_argument('-n', '--simulate', action='store_true',
                                 help='simulate the run, without processing any file')
+    process_parser.add_argument('-r', '--in-process', action='store_true',
+                                help='run modules in long-lived worker processes')
+    process_parser.add_argument('-c', '--cache', action='store_true',
+                                help='reuse module outputs from the stage cache')
+    process_parser.add_argument('-F', '--force', action='store_true',
+                                help='run all modules, even if recorded as completed')
     process_parser.set_defaults(func=process)
 
+    # cache sub-command
+    cache_parser = sub_parsers.add_parser('cache', help='manage the stage cache')
+    cache_parser.add_argument(
+        'action', choices=['stats', 'prune'], help='show statistics or prune the cache')
+    cache_parser.add_argument('-s', '--max-size', metavar='size', type=parse_size,
+                              default=CACHE_SIZE, help='size limit for prune, e.g. 500M, 20G')
+    cache_parser.set_defaults(func=cache_)
+
+    # stats sub-command
+    stats_parser = sub_parsers.add_parser(
+        'stats', help='show module statistics from the metrics logs')
+    stats_parser.add_argument('-p', '--process-id', metavar='process_id',
+                              help='only include this process_id')
+    stats_parser.set_defaults(func=stats)
+
     # parse args and perform operations
     args = arg_parser.parse_args()
     args.func(args)
@@ -0,0 +1,391 @@
+"""
+Benchmark the vad module against its original loop-based implementations.
+
+Each benchmark runs a reference implementation (kept here, as it was in
+vad-1.0) and its current counterpart in modules/vad-1.0 on the same input,
+and reports both run times and the largest difference between the outputs.
+
+Requires numpy, scipy and soundfile (as for the vad module).
+
+With -p, instead reports the agreement of the float32 processing mode with
+float64: per-frame speaker labels and segment boundaries of gen_final_vad on
+three channels (the input, shifted by 0, 1/3 and 2/3 of its length).
+
+Usage: python bench_vad.py [-w wav_file] [-s seconds] [-p] [benchmark ...]
+"""
+
+import argparse
+import imp
+import math
+import os
+import random
+import time
+from copy import deepcopy
+
+import numpy as np
+import scipy.fftpack
+import scipy.signal
+
+UTILS_DIR = os.path.dirname(os.path.realpath(__file__))
+ROOT_DIR = os.path.dirname(UTILS_DIR)
+VAD_MODULE = os.path.join(ROOT_DIR, 'modules', 'vad-1.0', 'module.py')
+
+
+def ref_cal_power_sum_seg(audio, sample_rate):
+    """Reference cal_power_sum_seg, with per-sample and per-frame loops."""
+    flength = int(sample_rate * 0.025)
+    hsize = int(sample_rate * 0.01)
+    audio_len = len(audio)
+    audio = audio.copy()
+    for i in range(audio_len):
+        audio[i] = audio[i] + np.random.randn() / (pow(2, 32))
+    audio = scipy.signal.lfilter(
+        np.array([0.999, -0.999]), np.array([1, -0.999]), audio)
+    tmp_audio = np.zeros(audio_len)
+    for i in range(1, audio_len):
+        tmp_audio[i] = audio[i] - 0.97 * audio[i - 1]
+    tmp_audio[0] = audio[0]
+    audio = tmp_audio
+    num_frame = int(math.floor((audio_len - flength) / hsize + 1))
+    spec = np.zeros((257, num_frame), dtype=np.complex128)
+    for i in range(num_frame):
+        frame_dat = audio[i * hsize: i * hsize + flength]
+        frame_dat = frame_dat * np.hamming(flength)
+        result = scipy.fftpack.fft(frame_dat, 512)
+        spec[:, i] = result[0:result.size // 2 + 1]
+    return np.multiply(spec, np.conjugate(spec)).real.sum(axis=0)
+
+
+def ref_batch_peridoc_pitch_count_fast(test_wave, sample_rate, nframe,
+                                       nsample_per_frame, nsample_forward):
+    """Reference batch_peridoc_pitch_count_fast, with per-frame and per-bin loops."""
+    x_start = 0
+    x_end = nsample_per_frame
+    act_frame_x = np.zeros((nsample_per_frame * 2, nframe))  # A matrix
+    for j in range(nframe):
+        tmp_arr = np.concatenate(
+            [test_wave[x_start:x_end], np.zeros(x_end - x_start)])
+        act_frame_x[:, j] = tmp_arr
+        x_start = x_start + nsample_forward
+        x_end = x_end + nsample_forward
+
+    frame_size, nfr = act_frame_x.shape
+    bin_width = sample_rate / frame_size
+    hamm_frame = np.hamming(frame_size)
+    hpfreq_upper = 800
+    n_hpfreq_upper_bin = int(math.ceil(hpfreq_upper / bin_width))
+
+    # frequency filtering
+    map_x = list(range(1, n_hpfreq_upper_bin + 1))  # [1:n_hpfreq_upper_bin]
+    map_x = 1.0 / n_hpfreq_upper_bin * np.array(map_x)  # map_x = map_x'
+    frame_x = np.zeros((nsample_per_frame * 2, nframe))
+    for i in range(nfr):
+        tmp_norm = np.linalg.norm(act_frame_x[:, i])
+        if tmp_norm == 0:
+            for j in range(frame_x.shape[0]):
+                frame_x[j, i] = random.random() * 0.00001
+            continue
+        frame_x[:, i] = act_frame_x[:, i] / np.linalg.norm(act_frame_x[:, i])
+        # so that signal level is NOT at play here!!!
+    frame_x_hamm = np.zeros((nsample_per_frame * 2, nframe))
+    for i in range(nfr):
+        frame_x_hamm[:, i] = np.multiply(frame_x[:, i], hamm_frame)
+    abs_fft_x = np.absolute(np.fft.fft(
+        frame_x_hamm, axis=0))  # PLEASE CHECK
+    for i in range(nfr):
+        abs_fft_x[:n_hpfreq_upper_bin, i] = np.multiply(
+            abs_fft_x[:n_hpfreq_upper_bin, i], map_x)
+    max_each_col = np.reciprocal(np.amax(
+        abs_fft_x[:2 * hpfreq_upper / bin_width, :], axis=0))
+    for i in range(frame_size):
+        abs_fft_x[i, :] = np.multiply(abs_fft_x[i, :], max_each_col)
+
+    # extract noise level from 2K-3K freq range
+    abs_fft_x = np.power(abs_fft_x, 1.2)  # abs_fft_x = abs_fft_x.^1.2
+    second_dim = abs_fft_x.shape[1]
+    bin_width = (sample_rate / (math.floor(frame_size / 2) * 2))
+    # pitch_range_lower = 80, pitch_range_upper = 250
+    pitch_idx_range = int(math.ceil(250 - 80) / bin_width)
+    val_hist_peak = np.zeros((second_dim, pitch_idx_range))
+    val_hist_trough = np.zeros((second_dim, pitch_idx_range))
+    sum_peak_val = np.zeros((second_dim, pitch_idx_range, 6))
+    sum_trough_val = np.zeros((second_dim, pitch_idx_range, 6))
+    beam_width = 2
+
+    for i in range(pitch_idx_range):
+        # pitch_range_lower = 80
+        pitch_val = math.floor(((80 / bin_width) + i) * bin_width)
+        # number of harmonics, skipping the first harmonics bcos very noisy!!!
+        for j in range(1, 7):
+            # PLEASE CHECK
+            idx = int(math.floor(((j + 1) * pitch_val) / bin_width))
+            idx_trough = int(math.floor(idx + (pitch_val / (2 * bin_width))))
+            tmp_mat_pi = abs_fft_x[idx - beam_width - 1:idx + beam_width, :]
+            p_i = tmp_mat_pi.sum(axis=0)
+            tmp_mat_ti = abs_fft_x[idx_trough -
+                                   beam_width - 1:idx_trough + beam_width, :]
+            t_i = tmp_mat_ti.sum(axis=0)
+            sum_peak_val[:, i, j - 1] = p_i
+            sum_trough_val[:, i, j - 1] = t_i
+
+    sum_peak = sum_peak_val.sum(axis=2)
+    sum_trough = sum_trough_val.sum(axis=2)
+    val_hist_trough = np.power(sum_trough, 2)
+
+    for i in range(pitch_idx_range):
+        curr_sum_peak_val = sum_peak_val[:, i, :].squeeze().transpose()
+        curr_sum_trough_val = sum_trough_val[:,
+                                             i, :].squeeze().conj().transpose()
+        val_hist_peak[:, i] = np.power(sum_peak[:, i], 2) - \
+            np.var(curr_sum_peak_val, axis=0, ddof=1).transpose() - \
+            np.var(curr_sum_trough_val, axis=0, ddof=1).transpose()
+
+    val_hist_peak_conj_transp = val_hist_peak.conj().transpose()
+    vhp_max = val_hist_peak_conj_transp.max(0)
+    vhp_argmax = val_hist_peak_conj_transp.argmax(0)
+    vhp_2 = np.zeros(nfr)
+    for i in range(nfr):
+        vhp_2[i] = abs(val_hist_trough[i, vhp_argmax[i]])
+    val_feature = np.divide(vhp_max, vhp_2)
+    return val_feature
+
+
+def bench_power_sum(vad, audio, sample_rate):
+    """Benchmark cal_power_sum_seg."""
+    np.random.seed(0)
+    start = time.time()
+    ref = ref_cal_power_sum_seg(audio, sample_rate)
+    ref_time = time.time() - start
+    np.random.seed(0)
+    start = time.time()
+    new = vad.cal_power_sum_seg(audio, sample_rate)
+    new_time = time.time() - start
+    return ref_time, new_time, np.max(np.abs(ref - new) / np.maximum(np.abs(ref), 1e-12))
+
+
+def bench_pitch(vad, audio, sample_rate):
+    """Benchmark batch_peridoc_pitch_count_fast, with the combine_vad framing."""
+    nsample_per_frame = int(0.1 * sample_rate)
+    nsample_forward = int(0.02 * sample_rate)
+    nframes = int(math.floor((len(audio) - nsample_per_frame) * 1.0 / nsample_forward))
+    args = (audio, sample_rate, nframes, nsample_per_frame, nsample_forward)
+    start = time.time()
+    ref = ref_batch_peridoc_pitch_count_fast(*args)
+    ref_time = time.time() - start
+    start = time.time()
+    new = vad.batch_peridoc_pitch_count_fast(*args)
+    new_time = time.time() - start
+    return ref_time, new_time, np.max(np.abs(ref - new) / np.maximum(np.abs(ref), 1e-12))
+
+
+def ref_median_filter(audio, filter_len):
+    """Reference median_filter, with np.median on every window."""
+    nframes = len(audio)
+    hlen = (filter_len - 1) / 2
+    audio_copy = deepcopy(audio)
+    for i in range(hlen, nframes - hlen):
+        audio_copy[i] = np.median(audio[i - hlen:i + hlen + 1])
+    return audio_copy
+
+
+def bench_median(vad, audio, sample_rate):
+    """Benchmark median_filter on channel ids, VAD flags and continuous values."""
+    nframes = len(audio) * 100 // sample_rate
+    rng = np.random.RandomState(0)
+    inputs = [(np.repeat(rng.randint(1, 5, nframes // 20 + 1), 20)[:nframes], 51),
+              (np.repeat(rng.randint(0, 2, nframes // 10 + 1), 10)[:nframes] * 1.0, 3),
+              (rng.randn(nframes), 51)]
+    ref_time = new_time = diff = 0
+    for values, filter_len in inputs:
+        start = time.time()
+        ref = ref_median_filter(values, filter_len)
+        ref_time += time.time() - start
+        start = time.time()
+        new = vad.median_filter(values, filter_len)
+        new_time += time.time() - start
+        diff = max(diff, np.max(np.abs(ref - new)))
+    return ref_time, new_time, diff
+
+
+def ref_channel_dominance(power_sums):
+    """Reference channel dominance of gen_final_vad, with vstack and loops."""
+    power_sum = np.empty((0, len(power_sums[0])), dtype=np.double)
+    nframes = len(power_sums[0])
+    for curr_power_sum in power_sums:
+        power_sum = np.vstack([power_sum, curr_power_sum])
+
+    sum_all = np.sum(power_sum, axis=0)
+    power_sum_norm = np.zeros(power_sum.shape)
+    for i in range(nframes):
+        power_sum_norm[:i] = np.divide(power_sum[:i], sum_all)
+
+    channels = np.argmax(power_sum_norm, axis=0)
+    for i in range(len(channels)):
+        channels[i] = channels[i] + 1
+    return ref_median_filter(channels, 51)
+
+
+def bench_dominance(vad, audio, sample_rate):
+    """Benchmark channel dominance on 4 channels, and check the streaming form."""
+    power_sum = vad.cal_power_sum_seg(audio, sample_rate)
+    power_sums = [np.roll(power_sum, k * 100) for k in range(4)]
+    start = time.time()
+    ref = ref_channel_dominance(power_sums)
+    ref_time = time.time() - start
+    start = time.time()
+    new = vad.median_filter(vad.dominant_channels(
+        vad.normalize_power(np.vstack(power_sums))), 51)
+    new_time = time.time() - start
+
+    # push the same frames in random chunks
+    rng = np.random.RandomState(0)
+    stacked = np.vstack(power_sums)
+    dominance = vad.ChannelDominance(51)
+    streamed = list()
+    pos = 0
+    while pos < stacked.shape[1]:
+        step = rng.randint(1, 200)
+        streamed.append(dominance.push(stacked[:, pos:pos + step]))
+        pos += step
+    streamed.append(dominance.flush())
+    streamed = np.concatenate(streamed)
+    if len(streamed) != len(ref):
+        return ref_time, new_time, np.inf
+    return ref_time, new_time, max(np.max(np.abs(ref - new)), np.max(np.abs(ref - streamed)))
+
+
+def ref_modify_signal(tmp_audio, spk_id_smooth_refined, hsize, flength):
+    """Reference modify_signal, with per-sample loops."""
+    audio = deepcopy(tmp_audio)
+    nsample = len(tmp_audio[0, :])
+
+    spk_id_smooth_refined_len = len(spk_id_smooth_refined)
+    for j in range(spk_id_smooth_refined_len):
+        active_channel = spk_id_smooth_refined[j]
+        start_frame = j * hsize
+        end_frame = min(start_frame + flength, nsample)
+
+        for i in range(len(tmp_audio)):
+            if i != active_channel - 1:
+                for k in range(start_frame, end_frame):
+                    if abs(audio[i, k]) == 0:
+                        continue
+                    audio[i, k] = audio[i, k] * \
+                        random.random() / (abs(audio[i, k]) * 10000000000)
+    return audio
+
+
+def bench_modify(vad, audio, sample_rate):
+    """Benchmark modify_signal on 4 channels, with random active channels."""
+    hsize = int(sample_rate * 0.01)
+    flength = int(sample_rate * 0.025)
+    rng = np.random.RandomState(0)
+    chans = np.vstack([np.roll(audio, k * sample_rate) for k in range(4)])
+    nframes = (chans.shape[1] - flength) // hsize + 1
+    labels = np.repeat(rng.randint(0, 5, nframes // 50 + 1), 50)[:nframes]
+    start = time.time()
+    ref = ref_modify_signal(chans, labels, hsize, flength)
+    ref_time = time.time() - start
+    start = time.time()
+    new = vad.modify_signal(chans.copy(), labels, hsize, flength)
+    new_time = time.time() - start
+    # attenuated samples are random, compare which samples were attenuated
+    if not np.array_equal(np.abs(ref) < 1e-10, np.abs(new) < 1e-10):
+        return ref_time, new_time, np.inf
+    return ref_time, new_time, np.max(np.abs(ref - new))
+
+
+BENCHMARKS = [
+    ('cal_power_sum_seg', bench_power_sum),
+    ('batch_peridoc_pitch_count_fast', bench_pitch),
+    ('median_filter', bench_median),
+    ('channel_dominance', bench_dominance),
+    ('modify_signal', bench_modify),
+]
+
+
+def synthetic_audio(seconds, sample_rate):
+    """Return a test signal of voiced bursts (harmonics of 80-250 Hz) in noise."""
+    rng = np.random.RandomState(0)
+    nsample = int(seconds * sample_rate)
+    audio = 0.01 * rng.randn(nsample)
+    t_burst = np.arange(sample_rate) * 1.0 / sample_rate
+    for start in range(0, nsample - sample_rate, 2 * sample_rate):
+        pitch = rng.uniform(80, 250)
+        burst = sum(np.sin(2 * np.pi * k * pitch * t_burst) / k for k in range(1, 8))
+        audio[start:start + sample_rate] += 0.2 * burst
+    return audio
+
+
+def segment_bounds(labels):
+    """Return the frames where the label changes."""
+    return np.flatnonzero(np.diff(labels)) + 1
+
+
+def precision_report(vad, audio, sample_rate):
+    """Compare the VAD of the float32 and float64 processing modes."""
+    shift = len(audio) // 3
+    chans = np.vstack([np.roll(audio, k * shift) for k in range(3)])
+    labels = dict()
+    for precision in ['float64', 'float32']:
+        start = time.time()
+        features = [vad.channel_vad(chan.astype(precision), sample_rate,
+                                    np.random.RandomState(k))
+                    for k, chan in enumerate(chans)]
+        labels[precision], _ = vad.gen_final_vad(
+            np.vstack([power_sum for power_sum, _ in features]),
+            np.vstack([pitch_vad for _, pitch_vad in features]), precision, None)
+        print('{:<10} {:.3f} s'.format(precision, time.time() - start))
+
+    ref, new = labels['float64'], labels['float32']
+    ref_bounds, new_bounds = segment_bounds(ref), segment_bounds(new)
+    print('frames with different labels: {} of {} ({:.3%})'.format(
+        np.sum(ref != new), len(ref), np.mean(ref != new)))
+    print('segment boundaries: {} (float64), {} (float32)'.format(
+        len(ref_bounds), len(new_bounds)))
+    if len(ref_bounds) and len(new_bounds):
+        # distance from each boundary to the nearest one of the other mode
+        dist = np.abs(ref_bounds[:, np.newaxis] - new_bounds).min(axis=1)
+        print('boundary shift (frames): max {}, mean {:.3f}, moved {}'.format(
+            dist.max(), dist.mean(), np.sum(dist > 0)))
+
+
+def main():
+    """Run the benchmarks."""
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('-w', '--wav', metavar='wav_file',
+                            help='input audio (first channel is used), default synthetic')
+    arg_parser.add_argument('-s', '--seconds', type=float, default=60,
+                            help='seconds of audio to use')
+    arg_parser.add_argument('-p', '--precision', action='store_true',
+                            help='report float32 against float64 agreement instead')
+    arg_parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                            help='benchmarks to run (default: all)')
+    args = arg_parser.parse_args()
+
+    vad = imp.load_source('vad_module', VAD_MODULE)
+    sample_rate = 16000
+    if args.wav:
+        import soundfile as sf
+        audio, sample_rate = sf.read(args.wav, frames=int(args.seconds * 16000))
+        if audio.ndim > 1:
+            audio = audio[:, 0]
+    else:
+        audio = synthetic_audio(args.seconds, sample_rate)
+    if args.precision:
+        precision_report(vad, audio, sample_rate)
+        return
+
+    row = '{:<32} {:>10} {:>10} {:>9} {:>12}'
+    print(row.format('benchmark', 'ref (s)', 'new (s)', 'speedup', 'max diff'))
+    for name, bench in BENCHMARKS:
+        if args.benchmarks and name not in args.benchmarks:
+            continue
+        ref_time, new_time, diff = bench(vad, audio, sample_rate)
+        print(row.format(name, '{:.3f}'.format(ref_time), '{:.3f}'.format(new_time),
+                         '{:.1f}x'.format(ref_time / max(new_time, 1e-9)),
+                         '{:.3g}'.format(diff)))
+
+
+if __name__ == '__main__':
+    main()
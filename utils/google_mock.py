@@ -0,0 +1,206 @@
+"""
+Serve a local stand-in for the Google Cloud Speech recognize endpoint.
+
+Requests are answered with canned transcripts, after a latency drawn from a
+configurable distribution, and fail with UNAVAILABLE or RESOURCE_EXHAUSTED
+(quota exceeded) at configurable rates, or past a requests per minute quota.
+Words are spread evenly over the audio, with time offsets. Requests over the
+synchronous limit of 60 seconds of audio are refused as by the real service.
+
+Point the google module at the server with
+    GOOGLE_SPEECH_ENDPOINT=localhost:50051 python module.py process_id file_id
+or its --endpoint option. Request statistics are printed on exit.
+
+Requires google-cloud-speech (as for the google module).
+
+Usage: python google_mock.py [-p port] [-l latency] [-r rtf] [-e rate] [-q rate]
+                             [-m requests_per_minute] [-t transcript_file] [-w workers]
+                             [--seed seed]
+
+Latency distributions are given as name:args, in seconds:
+    fixed:0.3  uniform:0.1,0.5  normal:0.3,0.1  lognormal:-1.2,0.5
+"""
+
+import argparse
+import hashlib
+import random
+import struct
+import threading
+import time
+from collections import deque
+from concurrent import futures
+
+import grpc
+from google.cloud.speech_v1.proto import cloud_speech_pb2, cloud_speech_pb2_grpc
+
+SYNC_LIMIT = 60  # max seconds of audio per synchronous request
+TRANSCRIPTS = [
+    'good morning singapore you are listening to the breakfast show',
+    'traffic is building up along the pan island expressway towards the city',
+    'and that was the latest from our newsroom stay tuned for more',
+    'we will be right back after these messages',
+    'thank you for calling in what would you like to say to our listeners'
+]
+FLAC = cloud_speech_pb2.RecognitionConfig.FLAC
+
+
+def parse_latency(spec):
+    """Return a function drawing latencies in seconds from a distribution spec."""
+    name, _, args = spec.partition(':')
+    args = [float(x) for x in args.split(',')] if args else []
+    dists = {'fixed': lambda rng, x: x,
+             'uniform': lambda rng, lo, hi: rng.uniform(lo, hi),
+             'normal': lambda rng, mu, sigma: max(0, rng.gauss(mu, sigma)),
+             'lognormal': lambda rng, mu, sigma: rng.lognormvariate(mu, sigma)}
+    if name not in dists:
+        raise argparse.ArgumentTypeError('unknown latency distribution: {}'.format(name))
+    return lambda rng: dists[name](rng, *args)
+
+
+def audio_duration(config, content):
+    """Return the duration in seconds of LINEAR16 or FLAC audio."""
+    if config.encoding == FLAC and content[:4] == b'fLaC':
+        # STREAMINFO: 20 bits sample rate, 3 channels, 5 bits per sample, 36 samples
+        info = struct.unpack('>Q', content[18:26])[0]
+        return float(info & (2**36 - 1)) / (info >> 44)
+    channels = max(1, config.audio_channel_count)
+    return float(len(content)) / (2 * channels) / config.sample_rate_hertz
+
+
+class MockSpeech(cloud_speech_pb2_grpc.SpeechServicer):
+    """Class answering recognize requests with canned transcripts.
+
+    Syntax:
+        servicer = MockSpeech(latency, rtf, error_rate, quota_rate, transcripts, seed,
+                              requests_per_minute)
+        servicer.summary()
+    """
+
+    def __init__(self, latency=parse_latency('fixed:0.3'), rtf=0.0, error_rate=0.0,
+                 quota_rate=0.0, transcripts=None, seed=None, requests_per_minute=0):
+        self.latency = latency
+        self.rtf = rtf
+        self.error_rate = error_rate
+        self.quota_rate = quota_rate
+        self.transcripts = transcripts or TRANSCRIPTS
+        self.rng = random.Random(seed)
+        self.requests_per_minute = requests_per_minute
+        self.window = deque()  # arrival times of the requests within quota, last minute
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'ok': 0, 'errors': 0, 'quota': 0, 'too_long': 0,
+                      'bytes': 0, 'seconds': 0.0, 'in_flight': 0, 'max_in_flight': 0}
+        self.start = time.time()
+
+    def Recognize(self, request, context):
+        """Answer a synchronous recognize request."""
+        duration = audio_duration(request.config, request.audio.content)
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['bytes'] += len(request.audio.content)
+            self.stats['in_flight'] += 1
+            self.stats['max_in_flight'] = max(self.stats['max_in_flight'],
+                                              self.stats['in_flight'])
+            latency = self.latency(self.rng) + self.rtf * duration
+            draw = self.rng.random()
+            now = time.time()
+            while self.window and self.window[0] < now - 60:
+                self.window.popleft()
+            over_quota = 0 < self.requests_per_minute <= len(self.window)
+            if not over_quota:
+                self.window.append(now)
+        try:
+            time.sleep(latency)
+            if duration > SYNC_LIMIT:
+                self.count('too_long')
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                              'Sync input too long. For audio longer than 1 min use '
+                              'LongRunningRecognize.')
+            if over_quota or draw < self.quota_rate:
+                self.count('quota')
+                context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, 'Quota exceeded.')
+            if draw < self.quota_rate + self.error_rate:
+                self.count('errors')
+                context.abort(grpc.StatusCode.UNAVAILABLE, 'Service unavailable.')
+            self.count('ok', duration)
+            return self.response(request, duration)
+        finally:
+            with self.lock:
+                self.stats['in_flight'] -= 1
+
+    def count(self, outcome, duration=0.0):
+        """Count a request outcome."""
+        with self.lock:
+            self.stats[outcome] += 1
+            self.stats['seconds'] += duration
+
+    def response(self, request, duration):
+        """Return the canned response for a request, chosen by its audio."""
+        index = int(hashlib.sha1(request.audio.content).hexdigest(), 16) % len(self.transcripts)
+        words = self.transcripts[index].split()
+        alternative = cloud_speech_pb2.SpeechRecognitionAlternative(
+            transcript=' '.join(words), confidence=0.9)
+        if request.config.enable_word_time_offsets:
+            step = duration / len(words)
+            for i, word in enumerate(words):
+                info = alternative.words.add(word=word)
+                info.start_time.FromNanoseconds(int(i * step * 1e9))
+                info.end_time.FromNanoseconds(int((i + 1) * step * 1e9))
+        return cloud_speech_pb2.RecognizeResponse(
+            results=[cloud_speech_pb2.SpeechRecognitionResult(alternatives=[alternative])])
+
+    def summary(self):
+        """Return a summary of the requests served so far."""
+        elapsed = time.time() - self.start
+        with self.lock:
+            stats = dict(self.stats)
+        return ('{requests} requests ({ok} ok, {errors} errors, {quota} quota exceeded, '
+                '{too_long} too long), max {max_in_flight} in flight, {bytes} bytes, '
+                '{seconds:.1f} s of audio transcribed; {rate:.2f} requests/s, '
+                '{rtf:.2f} s of audio/s').format(
+                    rate=stats['requests'] / elapsed, rtf=stats['seconds'] / elapsed, **stats)
+
+
+def serve(servicer, port=50051, workers=64):
+    """Start serving servicer on localhost:port, return the server."""
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=workers))
+    cloud_speech_pb2_grpc.add_SpeechServicer_to_server(servicer, server)
+    server.add_insecure_port('localhost:{}'.format(port))
+    server.start()
+    return server
+
+
+if __name__ == '__main__':
+    ARG_PARSER = argparse.ArgumentParser(
+        description='Serve a local stand-in for the Google Cloud Speech recognize endpoint.')
+    ARG_PARSER.add_argument('-p', '--port', type=int, default=50051,
+                            help='port to listen on, default 50051')
+    ARG_PARSER.add_argument('-l', '--latency', type=parse_latency, default='fixed:0.3',
+                            help='latency distribution, default fixed:0.3')
+    ARG_PARSER.add_argument('-r', '--rtf', type=float, default=0.0,
+                            help='extra latency per second of audio, default 0')
+    ARG_PARSER.add_argument('-e', '--error-rate', type=float, default=0.0,
+                            help='fraction of requests failing as unavailable, default 0')
+    ARG_PARSER.add_argument('-q', '--quota-rate', type=float, default=0.0,
+                            help='fraction of requests failing as quota exceeded, default 0')
+    ARG_PARSER.add_argument('-m', '--requests-per-minute', metavar='N', type=int, default=0,
+                            help='request quota, default none')
+    ARG_PARSER.add_argument('-t', '--transcripts', metavar='FILE',
+                            help='file of canned transcripts, one per line')
+    ARG_PARSER.add_argument('-w', '--workers', type=int, default=64,
+                            help='max number of requests served at once, default 64')
+    ARG_PARSER.add_argument('--seed', type=int, help='random seed')
+    ARGS = ARG_PARSER.parse_args()
+    TRANS = None
+    if ARGS.transcripts:
+        with open(ARGS.transcripts, 'r') as file_:
+            TRANS = [x.strip() for x in file_ if x.strip()]
+    SERVICER = MockSpeech(ARGS.latency, ARGS.rtf, ARGS.error_rate, ARGS.quota_rate, TRANS,
+                          ARGS.seed, ARGS.requests_per_minute)
+    SERVER = serve(SERVICER, ARGS.port, ARGS.workers)
+    print('Serving on localhost:{}, Ctrl-C to stop'.format(ARGS.port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        SERVER.stop(0).wait()
+        print(SERVICER.summary())